@@ -32,6 +32,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
+import sys
+import glob
+import shutil
+import tempfile
+import traceback
+import concurrent.futures
 
 try:
     import dfxml
@@ -61,10 +67,8 @@ except ImportError:
     sys.exit(1)
 
 ################################################################################
-def make_csv_files(files):
+def make_csv_files(files, files_csv="files.csv"):
     # Create CSV for file system entries
-    files_csv = "files.csv"
-
     with open(files_csv, 'w') as f:
         f.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % ("app_name",
                                                            "app_state",
@@ -92,10 +96,8 @@ def make_csv_files(files):
                                                                fi.alloc_inode,
                                                                fi.sha1))
 
-def make_csv_cells(cells):
+def make_csv_cells(cells, cells_csv="cells.csv"):
     # Create CSV for Registry entries
-    cells_csv = "cells.csv"
-
     with open(cells_csv, 'w') as f:
         f.write("%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % ("app_name",
                                                         "app_state",
@@ -119,22 +121,16 @@ def make_csv_cells(cells):
                                                             co.alloc,
                                                             co.data_type,
                                                             co.data,
-                                                            co.data_raw))
+                                                            co.data_raw_hex))
 
 
-################################################################################
-if __name__=='__main__':
-    import argparse
-    parser = argparse.ArgumentParser(description='''APXML2CSV.py''',
-formatter_class = argparse.RawTextHelpFormatter)
-    parser.add_argument('profile',
-                        help = 'Application Profile XML (APXML)')
-    args = parser.parse_args()
-
+def convert_profile(profile, files_csv, cells_csv):
+    """ Parse one APXML document and write its FileObjects and CellObjects
+        to CSV. Returns the (files_csv, cells_csv) pair. """
     files = list()
     cells = list()
 
-    apxml_obj = apxml.iterparse(args.profile)
+    apxml_obj = apxml.iterparse(profile)
 
     for obj in apxml_obj:
         if isinstance(obj, Objects.FileObject):
@@ -142,5 +138,160 @@ formatter_class = argparse.RawTextHelpFormatter)
         if isinstance(obj, Objects.CellObject):
             cells.append(obj)
 
-    make_csv_files(files)
-    make_csv_cells(cells)
+    make_csv_files(files, files_csv)
+    make_csv_cells(cells, cells_csv)
+    return (files_csv, cells_csv)
+
+def collect_profiles(paths):
+    """ Expand APXML file names, directories and glob patterns to a list
+        of profiles. Directories and globs are expanded in sorted order,
+        duplicates are dropped, and input order is otherwise preserved. """
+    profiles = list()
+    for path in paths:
+        if os.path.isdir(path):
+            expanded = sorted(glob.glob(os.path.join(path, "*.apxml")))
+        elif glob.has_magic(path):
+            expanded = sorted(glob.glob(path))
+        else:
+            expanded = [path]
+        for profile in expanded:
+            if profile not in profiles:
+                profiles.append(profile)
+    return profiles
+
+def profile_names(profiles):
+    """ Return a unique output name (the file name without extension)
+        for each profile. The first profile with a name keeps it, later
+        ones get the lowest numeric suffix that no other name uses. """
+    bases = [os.path.splitext(os.path.basename(profile))[0] for profile in profiles]
+    used = set(bases)
+    names = list()
+    seen = set()
+    for base in bases:
+        name = base
+        if base in seen:
+            i = 1
+            while base + "-" + str(i) in used:
+                i += 1
+            name = base + "-" + str(i)
+            used.add(name)
+        seen.add(base)
+        names.append(name)
+    return names
+
+def merge_csv(parts, out_fn):
+    """ Concatenate CSV files in the given order, keeping one header. """
+    with open(out_fn, 'w') as out:
+        for i, part in enumerate(parts):
+            with open(part, 'r') as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+def try_convert_profile(profile, files_csv, cells_csv):
+    """ Convert one profile in a worker process. Returns a (result, error)
+        tuple: the result of convert_profile and None, or None and a
+        description of the exception the profile failed with. Partial
+        output of a failed profile is removed. """
+    try:
+        return (convert_profile(profile, files_csv, cells_csv), None)
+    except Exception as e:
+        for fn in (files_csv, cells_csv):
+            if os.path.exists(fn):
+                os.remove(fn)
+        return (None, traceback.format_exception_only(type(e), e)[-1].strip())
+
+def batch_convert(profiles, output_dir=".", jobs=None, merge=False):
+    """ Convert many APXML documents to CSV using a process pool.
+
+        Each worker parses and writes one profile at a time, so memory per
+        worker is bounded by the largest single profile. Without merge,
+        each profile is written to <name>-files.csv and <name>-cells.csv.
+        With merge, the per-profile CSV files are written to a temporary
+        directory and concatenated into files.csv and cells.csv in profile
+        order, so the output does not depend on worker scheduling.
+
+        A profile that fails is reported and left out, and the others are
+        still converted. Returns a (results, failures) tuple: the result of
+        convert_profile for each profile (None if it failed), and a list
+        of (profile, error) tuples. """
+    names = profile_names(profiles)
+
+    if merge:
+        part_dir = tempfile.mkdtemp(dir=output_dir)
+    else:
+        part_dir = output_dir
+
+    try:
+        results = [None] * len(profiles)
+        failures = list()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = dict()
+            for i, (profile, name) in enumerate(zip(profiles, names)):
+                files_csv = os.path.join(part_dir, name + "-files.csv")
+                cells_csv = os.path.join(part_dir, name + "-cells.csv")
+                future = executor.submit(try_convert_profile, profile, files_csv, cells_csv)
+                futures[future] = i
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                (results[i], error) = future.result()
+                if error is None:
+                    print("  > %s" % profiles[i])
+                else:
+                    failures.append((profiles[i], error))
+                    print("  > %s: FAILED: %s" % (profiles[i], error))
+
+        if merge:
+            converted = [r for r in results if r is not None]
+            merge_csv([r[0] for r in converted], os.path.join(output_dir, "files.csv"))
+            merge_csv([r[1] for r in converted], os.path.join(output_dir, "cells.csv"))
+    finally:
+        if merge:
+            shutil.rmtree(part_dir)
+
+    return (results, failures)
+
+################################################################################
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='''APXML2CSV.py''',
+formatter_class = argparse.RawTextHelpFormatter)
+    parser.add_argument('profiles',
+                        help = 'Application Profile XML (APXML) files, directories or globs',
+                        nargs = '+')
+    parser.add_argument('-o',
+                        help = 'Output directory (default: current directory)',
+                        action = 'store',
+                        default = '.',
+                        required = False)
+    parser.add_argument('-j',
+                        help = 'Number of worker processes (default: CPU count)',
+                        action = 'store',
+                        type = int,
+                        required = False)
+    parser.add_argument('--merge',
+                        help = 'Merge all profiles into one files.csv and cells.csv',
+                        action = 'store_true')
+    args = parser.parse_args()
+
+    profiles = collect_profiles(args.profiles)
+    if not profiles:
+        print("Error: APXML2CSV.py")
+        print("       No APXML documents found")
+        sys.exit(1)
+
+    if not os.path.isdir(args.o):
+        os.makedirs(args.o)
+
+    if len(args.profiles) == 1 and os.path.isfile(args.profiles[0]):
+        # A single profile keeps the original files.csv/cells.csv output
+        convert_profile(profiles[0],
+                        os.path.join(args.o, "files.csv"),
+                        os.path.join(args.o, "cells.csv"))
+    else:
+        (results, failures) = batch_convert(profiles, args.o, args.j, args.merge)
+        if failures:
+            print("Error: APXML2CSV.py")
+            print("       %d of %d profiles failed" % (len(failures), len(profiles)))
+            sys.exit(1)
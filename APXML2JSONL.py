@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Author:  Thomas Laurenson
+Email:   thomas@thomaslaurenson.com
+Website: thomaslaurenson.com
+Date:    2016/01/04
+
+Description:
+The APXML2JSONL.py Python module converts an APXML document to JSON Lines
+format. The output is one header line, one line per FileObject or
+CellObject, and one rusage line. Use apxml.parse_jsonl to read it back.
+
+Copyright (c) 2016, Thomas Laurenson
+
+###############################################################################
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+>>> CHANGELOG:
+    0.1.0       Base functionality ()
+
+"""
+
+import os
+import sys
+import json
+
+try:
+    import Objects
+except ImportError:
+    print("Error: APXML2JSONL.py")
+    print("       The Objects.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import apxml
+except ImportError:
+    print("Error: APXML2JSONL.py")
+    print("       The apxml.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+################################################################################
+def make_jsonl(profile, out_fh):
+    """ Stream an APXML document to JSON Lines. Each object is written as
+        soon as it is parsed, so only one object is held in memory. """
+    apxml_obj = apxml.APXMLObject()
+    header = False
+
+    for obj in apxml.iterparse_objects(profile, apxml_obj):
+        # The metadata and creator elements precede all objects
+        if not header:
+            out_fh.write(json.dumps(apxml.header_to_dict(apxml_obj)) + "\n")
+            header = True
+        out_fh.write(json.dumps(apxml.object_to_dict(obj)) + "\n")
+
+    if not header:
+        out_fh.write(json.dumps(apxml.header_to_dict(apxml_obj)) + "\n")
+    out_fh.write(json.dumps(apxml.rusage_to_dict(apxml_obj)) + "\n")
+
+################################################################################
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='''APXML2JSONL.py''',
+formatter_class = argparse.RawTextHelpFormatter)
+    parser.add_argument('profile',
+                        help = 'Application Profile XML (APXML)')
+    parser.add_argument('-o',
+                        help = 'JSON Lines output (default: <profile>.jsonl)',
+                        action = 'store',
+                        required = False)
+    args = parser.parse_args()
+
+    if args.o:
+        out_fi = args.o
+    else:
+        # Set the output filename based on profile
+        fn = os.path.basename(args.profile)
+        fn = os.path.splitext(fn)[0]
+        out_fi = fn + ".jsonl"
+
+    with open(out_fi, "w", encoding="utf-8") as f:
+        make_jsonl(args.profile, f)
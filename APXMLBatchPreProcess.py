@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+Author:  Thomas Laurenson
+Email:   thomas@thomaslaurenson.com
+Website: thomaslaurenson.com
+Date:    2016/01/04
+
+Description:
+The APXMLBatchPreProcess.py Python module pre-processes a library of
+APXML documents (see APXMLPreProcess.py). Profiles are given as files,
+directories or glob patterns, and are normalised in a pool of processes.
+Each profile is streamed, so the memory used by a process does not
+depend on profile size. A failed profile is reported, and the remaining
+profiles are still processed. A manifest records the content hash of
+each profile, the normalization version and the output, so profiles
+that are up to date are skipped.
+
+Copyright (c) 2016, Thomas Laurenson
+
+###############################################################################
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+>>> CHANGELOG:
+    0.1.0       Base functionality ()
+
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import traceback
+import concurrent.futures
+
+try:
+    import FilePathNormalizer
+except ImportError:
+    print('Error: APXMLBatchPreProcess.py')
+    print('       The FilePathNormalizer.py module is required.')
+    print('       You can download from: https://github.com/thomaslaurenson/Vestigium')
+    print('       Now Exiting...')
+    sys.exit(1)
+
+try:
+    import APXMLPreProcess
+except ImportError:
+    print("Error: APXMLBatchPreProcess.py")
+    print("       The APXMLPreProcess.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+################################################################################
+def _glob_base(pattern):
+    """ Return the directory part of a glob pattern before its first
+        wildcard. """
+    parts = pattern.replace("\\", "/").split("/")
+    base = list()
+    for part in parts[:-1]:
+        if glob.has_magic(part):
+            break
+        base.append(part)
+    return "/".join(base) or "."
+
+def find_profiles(inputs):
+    """ Return the APXML documents named by a list of files, directories
+        (searched recursively for *.apxml) and glob patterns, in order and
+        without duplicates, as (profile, subdir) tuples. subdir is the
+        directory of the profile relative to the directory (or the fixed
+        part of the glob pattern) it was found in, so outputs can mirror
+        the input tree; it is "" for files. Normalised profiles
+        (*-NORM.apxml) found in directories or by patterns are skipped. """
+    profiles = list()
+    for name in inputs:
+        if os.path.isdir(name):
+            base = name
+            found = list()
+            for (root, dirs, files) in os.walk(name):
+                dirs.sort()
+                for fn in sorted(files):
+                    if fn.lower().endswith(".apxml"):
+                        found.append(os.path.join(root, fn))
+        elif glob.has_magic(name):
+            base = _glob_base(name)
+            found = sorted(glob.glob(name, recursive=True))
+        else:
+            profiles.append((name, ""))
+            continue
+        for fn in found:
+            if not fn.endswith("-NORM.apxml"):
+                subdir = os.path.relpath(os.path.dirname(fn), base)
+                if subdir == os.curdir or subdir.startswith(os.pardir):
+                    subdir = ""
+                profiles.append((fn, subdir))
+
+    unique = list()
+    seen = set()
+    for (profile, subdir) in profiles:
+        if os.path.abspath(profile) not in seen:
+            seen.add(os.path.abspath(profile))
+            unique.append((profile, subdir))
+    return unique
+
+################################################################################
+MANIFEST_VERSION = 1
+
+def file_digest(fn, chunk_size=1048576):
+    """ Return the hex digest of the content of a file. """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest(object):
+    def __init__(self, fn):
+        """ Initialise Manifest object, reading the manifest file fn if it
+            exists. An entry per profile (by absolute path) holds the
+            content digest, size and modification time of the profile, the
+            normalization version (see APXMLPreProcess.rules_version), the
+            output file and its size, and the object count. """
+        self.fn = fn
+        self.entries = dict()
+        if os.path.exists(fn):
+            with open(fn) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest["profiles"]
+
+    def lookup(self, profile, fn, version):
+        """ Return the entry of a profile if its output fn is up to date,
+            except for the content of the profile, which the caller checks:
+            the version and output are the same, and the output exists,
+            unchanged. Returns None otherwise. """
+        entry = self.entries.get(os.path.abspath(profile))
+        if entry is None or entry["version"] != version or entry["output"] != os.path.abspath(fn):
+            return None
+        try:
+            if os.path.getsize(fn) != entry["output_size"]:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def unchanged(self, entry, profile):
+        """ Return True if a profile has the size and modification time of
+            its entry, so its content need not be hashed again. """
+        st = os.stat(profile)
+        return st.st_size == entry["size"] and st.st_mtime_ns == entry["mtime_ns"]
+
+    def update(self, profile, fn, version, digest, objects):
+        """ Record a profile and its output. """
+        st = os.stat(profile)
+        self.entries[os.path.abspath(profile)] = {"digest": digest,
+                                                  "size": st.st_size,
+                                                  "mtime_ns": st.st_mtime_ns,
+                                                  "version": version,
+                                                  "output": os.path.abspath(fn),
+                                                  "output_size": os.path.getsize(fn),
+                                                  "objects": objects}
+
+    def save(self):
+        """ Write the manifest file, replacing the previous one in a single
+            step. """
+        temp_fn = self.fn + ".tmp"
+        with open(temp_fn, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "profiles": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(temp_fn, self.fn)
+
+################################################################################
+# The Preprocessor of a worker process, so its path caches are shared by
+# every profile the worker processes
+_preprocessor = None
+
+def init_worker(rules):
+    """ Initialise a worker process. """
+    global _preprocessor
+    _preprocessor = APXMLPreProcess.Preprocessor(rules)
+
+def preprocess_profile(profile, fn, digest=False, known=None):
+    """ Pre-process one profile to fn in a worker process. With digest, the
+        content digest of the profile is computed first, and if it is
+        known, the output is up to date and the profile is skipped.
+        Returns a (profile, fn, objects, size, seconds, error, digest,
+        skipped) tuple, where error is None, or a description of the
+        exception the profile failed with. """
+    start = time.perf_counter()
+    try:
+        size = os.path.getsize(profile)
+        if digest:
+            digest = file_digest(profile)
+            if digest == known:
+                return (profile, fn, 0, size, time.perf_counter() - start, None, digest, True)
+        objects = _preprocessor.preprocess(profile, fn)
+    except Exception as e:
+        error = traceback.format_exception_only(type(e), e)[-1].strip()
+        # Do not leave a partial output behind
+        if os.path.exists(fn):
+            os.remove(fn)
+        return (profile, fn, 0, 0, time.perf_counter() - start, error, None, False)
+    return (profile, fn, objects, size, time.perf_counter() - start, None, digest or None, False)
+
+def batch_preprocess(profiles, output_dir=".", rules=None, jobs=None, manifest=None, force=False):
+    """ Generator. Pre-process a list of profiles to output_dir, using jobs
+        processes (default: one per CPU; 1 processes profiles in this
+        process). Profiles are file names, or (profile, subdir) tuples (see
+        find_profiles) to write the output to that subdirectory of
+        output_dir. Yields the result tuple of each profile (see
+        preprocess_profile) as it completes. Two profiles with the same
+        output file name fail, rather than overwrite each other. With a
+        Manifest, profiles whose output is up to date are skipped (unless
+        force), and the manifest is updated, but not saved. """
+    version = APXMLPreProcess.rules_version(rules)
+    tasks = list()
+    outputs = dict()
+    for profile in profiles:
+        subdir = ""
+        if isinstance(profile, tuple):
+            (profile, subdir) = profile
+        fn = APXMLPreProcess.norm_filename(profile, os.path.join(output_dir, subdir))
+        if fn in outputs:
+            yield (profile, fn, 0, 0, 0.0, "Same output file as %s" % outputs[fn], None, False)
+            continue
+        outputs[fn] = profile
+        known = None
+        if manifest is not None and not force:
+            entry = manifest.lookup(profile, fn, version)
+            if entry is not None:
+                # Like make, trust the size and modification time, and
+                # only hash a profile that was touched
+                if manifest.unchanged(entry, profile):
+                    yield (profile, fn, entry["objects"], entry["size"], 0.0, None, entry["digest"], True)
+                    continue
+                known = entry["digest"]
+        if not os.path.isdir(os.path.dirname(fn) or "."):
+            os.makedirs(os.path.dirname(fn))
+        tasks.append((profile, fn, manifest is not None, known))
+
+    def results():
+        if jobs == 1:
+            init_worker(rules)
+            for task in tasks:
+                yield preprocess_profile(*task)
+            return
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                    initializer=init_worker,
+                                                    initargs=(rules,)) as executor:
+            futures = [executor.submit(preprocess_profile, *task) for task in tasks]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+
+    for result in results():
+        (profile, fn, objects, size, seconds, error, digest, skipped) = result
+        if manifest is not None and error is None:
+            if skipped:
+                objects = manifest.entries[os.path.abspath(profile)]["objects"]
+                result = (profile, fn, objects, size, seconds, error, digest, skipped)
+            manifest.update(profile, fn, version, digest, objects)
+        yield result
+
+def write_failures(fn, failures):
+    """ Write the failed profiles to a CSV file. """
+    with open(fn, "w") as f:
+        f.write("profile,error\n")
+        for (profile, error) in failures:
+            f.write('"%s","%s"\n' % (profile.replace('"', '""'), error.replace('"', '""')))
+
+################################################################################
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='''APXMLBatchPreProcess.py''',
+formatter_class = argparse.RawTextHelpFormatter)
+    parser.add_argument('inputs',
+                        help = 'Application Profiles XML (APXML): files, directories\nor glob patterns',
+                        nargs='+')
+    parser.add_argument('-o',
+                        help = 'Output directory (default: current directory)',
+                        action = 'store',
+                        default = '.')
+    parser.add_argument('-j', '--jobs',
+                        help = 'Number of processes (default: one per CPU)',
+                        action = 'store',
+                        type = int,
+                        required = False)
+    parser.add_argument('--rules',
+                        help = 'JSON normalization rules file (see FilePathNormalizer.py)',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--manifest',
+                        help = 'Manifest file, used to skip up to date profiles\n(default: <output>/MANIFEST.json)',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--force',
+                        help = 'Pre-process every profile, even if up to date',
+                        action = 'store_true')
+    parser.add_argument('--failures',
+                        help = 'CSV file listing failed profiles (default: <output>/failures.csv)',
+                        action = 'store',
+                        required = False)
+    args = parser.parse_args()
+
+    rules = None
+    if args.rules:
+        rules = FilePathNormalizer.load_rules(args.rules)
+
+    profiles = find_profiles(args.inputs)
+    if not profiles:
+        parser.error("no APXML documents found")
+    if not os.path.isdir(args.o):
+        os.makedirs(args.o)
+
+    manifest = Manifest(args.manifest or os.path.join(args.o, "MANIFEST.json"))
+
+    start = time.perf_counter()
+    total_objects = 0
+    total_size = 0
+    skipped_count = 0
+    failures = list()
+    results = batch_preprocess(profiles, args.o, rules, args.jobs, manifest, args.force)
+    try:
+        for (i, result) in enumerate(results, 1):
+            (profile, fn, objects, size, seconds, error, digest, skipped) = result
+            if error is not None:
+                failures.append((profile, error))
+                print("  > [%d/%d] %s: FAILED: %s" % (i, len(profiles), profile, error))
+            elif skipped:
+                skipped_count += 1
+                print("  > [%d/%d] %s: up to date" % (i, len(profiles), profile))
+            else:
+                total_objects += objects
+                total_size += size
+                print("  > [%d/%d] %s: %d objects, %.2fs, %.1f MB/s" %
+                      (i, len(profiles), profile, objects, seconds, size / 1048576.0 / max(seconds, 1e-6)))
+    finally:
+        # Keep the profiles done so far, even if interrupted
+        manifest.save()
+
+    seconds = time.perf_counter() - start
+    print("Profiles:  %d (%d up to date, %d failed)" % (len(profiles), skipped_count, len(failures)))
+    print("Objects:   %d" % total_objects)
+    print("Time:      %.2fs (%.1f MB/s)" % (seconds, total_size / 1048576.0 / max(seconds, 1e-6)))
+
+    if failures:
+        fn = args.failures or os.path.join(args.o, "failures.csv")
+        write_failures(fn, failures)
+        print("Failures:  %s" % fn)
+        sys.exit(1)
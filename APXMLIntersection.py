@@ -35,6 +35,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import io
+import pickle
+import itertools
+import collections
+import concurrent.futures
 import xml.dom.minidom
     
 try:
@@ -64,37 +68,250 @@ except ImportError:
     print("       Now Exiting...")
     sys.exit(1)    
 
+try:
+    import MatchPolicy
+except ImportError:
+    print("Error: APXMLIntersection.py")
+    print("       The MatchPolicy.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+################################################################################
+def popcount(membership):
+    """ Number of profiles (set bits) in a membership bitmap. """
+    return bin(membership).count("1")
+
+def profile_mask(indices):
+    """ Membership bitmap with a bit set for each profile index. """
+    mask = 0
+    for i in indices:
+        mask |= 1 << i
+    return mask
+
+FILES_CSV_HEADER = "count,state,filename,delta,meta_type,alloc_name,alloc_inode,filesize,sha1"
+CELLS_CSV_HEADER = "count,state,cellpath,delta,name_type,alloc,data_type,data"
+
+# CSV output modes: a file per pass with every entry (pass), a file per
+# pass with the entries of that profile (delta), one file at the end (final)
+CSV_MODES = ["pass", "delta", "final", "none"]
+
+def membership_string(membership, profiles):
+    """ Membership bitmap as one 0/1 character per profile, in processing
+        order. """
+    return "".join("1" if membership >> i & 1 else "0" for i in range(profiles))
+
+def file_row(fi, extra=None):
+    """ CSV line of an accumulated FileObject (or ArtifactRecord). """
+    row = "%s,%s,%s,%s,%s,%s,%s,%s,%s" % (fi.count,
+                                          fi.app_state,
+                                          fi.filename,
+                                          "".join(fi.annos),
+                                          fi.meta_type,
+                                          fi.alloc_name,
+                                          fi.alloc_inode,
+                                          fi.filesize,
+                                          fi.sha1)
+    if extra is not None:
+        row += "," + extra
+    return row + "\n"
+
+def cell_row(co, extra=None):
+    """ CSV line of an accumulated CellObject (or ArtifactRecord). """
+    row = "%s,%s,%s,%s,%s,%s,%s,%s" % (co.count,
+                                       co.app_state,
+                                       co.cellpath,
+                                       "".join(co.annos),
+                                       co.name_type,
+                                       co.alloc,
+                                       co.data_type,
+                                       co.data)
+    if extra is not None:
+        row += "," + extra
+    return row + "\n"
+
+def write_csv(fn, header, rows, buffer_size=1048576):
+    """ Write a header and an iterable of CSV lines through a large write
+        buffer. """
+    with open(fn, "w", buffering=buffer_size) as f:
+        f.write(header + "\n")
+        f.writelines(rows)
+
+################################################################################
+class ArtifactStub(object):
+    """ Stands in for an accumulated object released in stream mode. Keeps
+        only the properties used for counting and statistics. """
+    def __init__(self, obj):
+        self.count = obj.count
+        self.membership = obj.membership
+        self.meta_type = getattr(obj, "meta_type", None)
+        self.name_type = getattr(obj, "name_type", None)
+
+################################################################################
+class ArtifactRecord(object):
+    """ Compact copy of a FileObject or CellObject made by a worker process.
+        Keeps the properties used for statistics and CSV output, and the
+        profile path and position needed to parse the object again. """
+    _file_properties = ["app_state", "filename", "annos", "meta_type",
+                        "alloc_name", "alloc_inode", "filesize", "sha1"]
+    _cell_properties = ["app_state", "cellpath", "annos", "name_type",
+                        "alloc", "data_type", "data"]
+
+    def __init__(self, obj, path, position):
+        self.path = path
+        self.position = position
+        self.count = 1
+        self.membership = 0
+        if isinstance(obj, Objects.FileObject):
+            properties = ArtifactRecord._file_properties
+        else:
+            properties = ArtifactRecord._cell_properties
+        for prop in properties:
+            setattr(self, prop, getattr(obj, prop))
+
+def load_profile_keys(profile, policy):
+    """ Worker process. Parse a profile and extract the match keys of its
+        objects. Returns the profile header (an APXMLObject without
+        objects), and lists of (key, probes, ArtifactRecord) for the files
+        and cells in document order. """
+    apxml_obj = apxml.APXMLObject()
+    files = list()
+    cells = list()
+    for (position, obj) in enumerate(apxml.iterparse_objects(profile, apxml_obj)):
+        if isinstance(obj, Objects.FileObject):
+            key = policy.file_key(obj)
+            files.append((key, policy.file_probes(obj, key), ArtifactRecord(obj, profile, position)))
+        elif isinstance(obj, Objects.CellObject):
+            key = policy.cell_key(obj)
+            cells.append((key, policy.cell_probes(obj, key), ArtifactRecord(obj, profile, position)))
+    apxml_obj.stats.all = len(files) + len(cells)
+    return (apxml_obj, files, cells)
+
+def load_state(fn):
+    """ Load an Intersection saved with Intersection.save_state. """
+    with open(fn, "rb") as f:
+        return pickle.load(f)
+
 ################################################################################
 # Intersection object
 class Intersection(object):
-    def __init__(self, profilesList):
+    def __init__(self, profilesList, policy=None, stream=False, jobs=1):
         self.profileList = list()
         self.order = list()
 
+        # In stream mode profiles are parsed one at a time during each
+        # pass, and only objects present in every profile so far are kept
+        self.stream = stream
+
+        # Match policy used to compute FileObject and CellObject keys
+        if policy is None:
+            policy = MatchPolicy.MatchPolicy()
+        self.policy = policy
+
         # DFXML and RegXML Objects to store FileObjects
         # and CellObjects found in the APXML documents
         self.dfxml_obj = Objects.DFXMLObject()
         self.regxml_obj = Objects.RegXMLObject()
 
+        # Hash tables of match key -> accumulated objects with that key
+        self.file_table = dict()
+        self.cell_table = dict()
+
         # Keep record of profile name for output
         self.out_fn = os.path.basename(profilesList[0])
         self.out_fn = os.path.splitext(self.out_fn)[0]
 
+        # With more than one job, worker processes parse the profiles and
+        # extract match keys. The passes then accumulate ArtifactRecords in
+        # plain lists, as DFXMLObject and RegXMLObject only take objects
+        loaded = None
+        self.records = jobs > 1 and not self.stream
+        if self.records:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                loaded = list(executor.map(load_profile_keys,
+                                           profilesList,
+                                           itertools.repeat(self.policy)))
+            self.dfxml_obj = list()
+            self.regxml_obj = list()
+
+        # Number of accumulated objects per (count, meta_type) and
+        # (count, name_type), updated as counts change during each pass
+        self.file_histogram = collections.Counter()
+        self.cell_histogram = collections.Counter()
+
+        # Stats line of each pass, kept for the state file
+        self.pass_stats = list()
+
         # Parse each APXML file to a OrderedDict
         for i, profile in enumerate(profilesList):
-            print("  > %s" % profile)
-            apxml_obj = apxml.iterparse(profile)
-            apxml.generate_stats(apxml_obj)
-            # Split the file system path for the application profile
-            name = profile.split('/')
-            name = name[0]
-            #name = name[len(name) - 1]
-            #name = name.split("-")[0]
-            apxml_obj.name = name
-            self.profileList.append(apxml_obj)
+            if loaded is not None:
+                self.profileList.append(self.load_profile(profile, loaded[i]))
+            else:
+                self.profileList.append(self.load_profile(profile))
+
+    def load_profile(self, profile, loaded=None):
+        """ Parse an APXML profile for the passes. loaded is the result of
+            load_profile_keys when a worker process already parsed it. """
+        print("  > %s" % profile)
+        apxml_obj_keys = None
+        if self.records:
+            if loaded is None:
+                loaded = load_profile_keys(profile, self.policy)
+            (apxml_obj, files, cells) = loaded
+            apxml_obj_keys = (files, cells)
+        else:
+            # Header only, objects are read in first_pass/next_pass and
+            # profiles are only sized when sort_profiles needs it
+            apxml_obj = apxml.APXMLObject()
+            apxml_obj.stats.all = None
+        apxml_obj.parsed = False
+        apxml_obj.path = profile
+        apxml_obj.keys = apxml_obj_keys
+        # Split the file system path for the application profile
+        name = profile.split('/')
+        name = name[0]
+        #name = name[len(name) - 1]
+        #name = name.split("-")[0]
+        apxml_obj.name = name
+        return apxml_obj
+
+    def add_profile(self, profile):
+        """ Fold one more profile into the intersection, after the profiles
+            already processed. Returns its position in self.order. """
+        count = len(self.order)
+        self.profileList.insert(count, self.load_profile(profile))
+        if count == 0:
+            self.first_pass()
+        else:
+            self.next_pass(count)
+        return count
+
+    def save_state(self, fn):
+        """ Save the intersection state (key tables, accumulated objects,
+            membership bitmaps, per-profile stats) to a pickle file. The
+            objects of processed profiles are dropped first, only their
+            headers are kept. ArtifactRecords (jobs > 1) refer back to the
+            profile files, so those must stay in place. """
+        for apxml_obj in self.order:
+            del apxml_obj._files[:]
+            del apxml_obj._cells[:]
+            apxml_obj.keys = None
+        with open(fn, "wb") as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    def print_stats(self):
+        """ Print the stored stats line of every pass. """
+        for row in self.pass_stats:
+            print(row)
 
     def sort_profiles(self, method):
         """ Sort profiles by selected method. """
+        if method not in [None, "none"]:
+            # Count start tags, profiles are parsed later in sorted order
+            for apxml_obj in self.profileList:
+                if apxml_obj.stats.all is None:
+                    apxml_obj.stats.all = sum(apxml.count_objects(apxml_obj.path))
+
         if method == None:
             pass
         elif method == "highest":
@@ -115,176 +332,274 @@ class Intersection(object):
                 self.profileList.append(h)
                 self.profileList.append(l)
 
+    def iter_profile(self, apxml_obj):
+        """ Iterate the FileObjects and CellObjects of a profile. In stream
+            mode the profile is parsed as it is iterated, otherwise it is
+            parsed the first time it is iterated. """
+        if self.stream:
+            return apxml.iterparse_objects(apxml_obj.path, apxml_obj)
+        if not apxml_obj.parsed:
+            # Parsed when first processed, and kept for profiles that are
+            # processed again (stacked order)
+            for obj in apxml.iterparse_objects(apxml_obj.path, apxml_obj):
+                apxml_obj.append(obj)
+            apxml_obj.parsed = True
+        return iter(apxml_obj)
+
+    def iter_keys(self, apxml_obj):
+        """ Yields (is_file, key, probes, obj) for each object of a profile.
+            Profiles loaded by worker processes yield ArtifactRecords with
+            the probes already extracted, otherwise probes is None. """
+        if apxml_obj.keys is not None:
+            (files, cells) = apxml_obj.keys
+            for (key, probes, record) in files:
+                yield (True, key, probes, record)
+            for (key, probes, record) in cells:
+                yield (False, key, probes, record)
+            return
+        for obj in self.iter_profile(apxml_obj):
+            if isinstance(obj, Objects.FileObject):
+                yield (True, self.file_key(obj), None, obj)
+            elif isinstance(obj, Objects.CellObject):
+                yield (False, self.cell_key(obj), None, obj)
+
     def first_pass(self):
         """ Process the first profile. """
         self.order.append(self.profileList[0])
-        for obj in self.profileList[0]:
-            if isinstance(obj, Objects.FileObject):
-                obj.count = 1
+        for (is_file, key, probes, obj) in self.iter_keys(self.profileList[0]):
+            # Bit 0 of the membership bitmap is the first profile
+            obj.membership = 1
+            obj.count = 1
+            if is_file:
                 self.dfxml_obj.append(obj)
-            if isinstance(obj, Objects.CellObject):
-                obj.count = 1
+                self.file_table.setdefault(key, []).append(obj)
+                self.file_histogram[(1, obj.meta_type)] += 1
+            else:
                 self.regxml_obj.append(obj)
+                self.cell_table.setdefault(key, []).append(obj)
+                self.cell_histogram[(1, obj.name_type)] += 1
+        self.release_keys(0)
 
     def next_pass(self, count):
         """ Prcoess each subsequent profile. """
         self.order.append(self.profileList[count])
-        for obj in self.profileList[count]:
-            match = False
-            if isinstance(obj, Objects.FileObject):
-                for fi in self.dfxml_obj:
-                    if self.compare_files(fi, obj):
-                        match = True
-                        if fi.count is None:
-                            obj.count = 1
-                            self.dfxml_obj.append(obj)
-                        else:
-                            fi.count += 1
-                if match == False:
-                    obj.count = 1
-                    self.dfxml_obj.append(obj)
-            elif isinstance(obj, Objects.CellObject):
-                for cell in self.regxml_obj:
-                    if self.compare_cells(cell, obj):
-                        match = True
-                        if cell.count is None:
-                            obj.count = 1
-                            self.regxml_obj.append(obj)
-                        else:
-                            cell.count += 1
-                if match == False:
-                    obj.count = 1
-                    self.regxml_obj.append(obj)
-
+        bit = 1 << (len(self.order) - 1)
+        for (is_file, key, probes, obj) in self.iter_keys(self.profileList[count]):
+            if is_file:
+                if probes is None:
+                    probes = self.policy.file_probes(obj, key)
+                self.join(self.file_table, self.dfxml_obj, self.file_histogram,
+                          "meta_type", key, probes, obj, bit)
+            else:
+                if probes is None:
+                    probes = self.policy.cell_probes(obj, key)
+                self.join(self.cell_table, self.regxml_obj, self.cell_histogram,
+                          "name_type", key, probes, obj, bit)
+        self.release_keys(count)
+        if self.stream:
+            self.release(bit)
+
+    def release_keys(self, count):
+        """ Drop the keys extracted by a worker process for the profile at
+            position count, unless a later pass processes it again (the
+            stacked order can repeat a profile). """
+        apxml_obj = self.profileList[count]
+        if not any(later is apxml_obj for later in self.profileList[count + 1:]):
+            apxml_obj.keys = None
+
+    def join(self, table, container, histogram, attr, key, probes, obj, bit):
+        """ Hash join one object against the accumulated objects. Every
+            accumulated object stored under one of the probe keys is
+            counted and marked present in this profile (bit). If there are
+            none, the object is added under its own key with a count of 1.
+            histogram is kept up to date by (count, attr) of each object. """
+        match = False
+        for probe in probes:
+            for accumulated in table.get(probe, ()):
+                kind = getattr(accumulated, attr)
+                histogram[(accumulated.count, kind)] -= 1
+                accumulated.count += 1
+                histogram[(accumulated.count, kind)] += 1
+                accumulated.membership |= bit
+                match = True
+        if match == False:
+            obj.count = 1
+            obj.membership = bit
+            histogram[(1, getattr(obj, attr))] += 1
+            if self.stream:
+                # Not in an earlier profile, so it cannot be in all of them
+                table[key] = [ArtifactStub(obj)]
+            else:
+                container.append(obj)
+                table[key] = [obj]
+
+    def release(self, bit):
+        """ Stream mode. Replace accumulated objects that are missing from
+            the profile just processed (bit) with stubs. Only objects in
+            every profile so far remain in dfxml_obj and regxml_obj. """
+        for (container, objs, table, key_func) in [
+                (self.dfxml_obj, self.dfxml_obj._files, self.file_table, self.file_key),
+                (self.regxml_obj, self.regxml_obj._cells, self.cell_table, self.cell_key)]:
+            keep = list()
+            for obj in objs:
+                if obj.membership & bit:
+                    keep.append(obj)
+                else:
+                    # Identity, as Objects __eq__ compares every property
+                    matches = table[key_func(obj)]
+                    for (i, match) in enumerate(matches):
+                        if match is obj:
+                            matches[i] = ArtifactStub(obj)
+            objs[:] = keep
+
+    def select(self, min_profiles=None, profiles=(), exclude=()):
+        """ Generator. Yields accumulated FileObjects, then CellObjects,
+            using their membership bitmaps: present in at least
+            min_profiles profiles, in every profile index of profiles, and
+            in no profile index of exclude. Indices follow self.order. In
+            stream mode, only objects in every profile are available. """
+        required = profile_mask(profiles)
+        excluded = profile_mask(exclude)
+        for container in (self.dfxml_obj, self.regxml_obj):
+            for obj in container:
+                membership = obj.membership
+                if membership & required != required:
+                    continue
+                if membership & excluded:
+                    continue
+                if min_profiles is not None and popcount(membership) < min_profiles:
+                    continue
+                yield obj
+
+    def membership_histogram(self):
+        """ Return a list where entry n is the number of accumulated objects
+            present in exactly n profiles. """
+        histogram = [0] * (len(self.order) + 1)
+        for table in (self.file_table, self.cell_table):
+            for matches in table.values():
+                for obj in matches:
+                    histogram[popcount(obj.membership)] += 1
+        return histogram
+
+    def file_key(self, fi):
+        """ Match key a FileObject (fi) is stored under. """
+        return self.policy.file_key(fi)
+
+    def cell_key(self, co):
+        """ Match key a CellObject (co) is stored under. """
+        return self.policy.cell_key(co)
 
     def compare_files(self, fi1, fi2):
-        """ Compare all metadata properties between two FileObjects (fi). """
-        if fi1.filename.endswith(".lnk"):
-            # Compare ShortCut (lnk) files
-            # Do not compare SHA-1 hash value
-            return (fi1.filename == fi2.filename and
-                    fi1.meta_type == fi2.meta_type and
-                    fi1.alloc_inode == fi2.alloc_inode and
-                    fi1.alloc_name == fi2.alloc_name and
-                    fi1.annos == fi2.annos and
-                    fi1.app_state == fi2.app_state)
-
-        elif fi1.filename.endswith(".pf"):
-            # Normalize Prefetch file for comparison, e.g.,
-            # Before: C:\Windows\Prefetch\TRUECRYPT.EXE-009A2E5A.pf
-            # After:  C:\Windows\Prefetch\TRUECRYPT.EXE
-            path1 = os.path.splitext(fi1.filename)[0]
-            path1 = path1.split("-")[0]
-            path2 = os.path.splitext(fi2.filename)[0]
-            path2 = path2.split("-")[0]
-            return (path1 == path2 and
-                    fi1.meta_type == fi2.meta_type and
-                    fi1.alloc_inode == fi2.alloc_inode and
-                    fi1.alloc_name == fi2.alloc_name and
-                    fi1.annos == fi2.annos and
-                    fi1.app_state == fi2.app_state)
-
-        # Default is to compare all object properties
-        return (fi1.filename == fi2.filename and
-                fi1.meta_type == fi2.meta_type and
-                fi1.sha1 == fi2.sha1 and
-                fi1.alloc_inode == fi2.alloc_inode and
-                fi1.alloc_name == fi2.alloc_name and
-                fi1.annos == fi2.annos and
-                fi1.app_state == fi2.app_state)
+        """ Compare two FileObjects (fi) using the match policy. """
+        return self.policy.compare_files(fi1, fi2)
 
     def compare_cells(self, co1, co2):
-        """ Compare all metadata properties between two CellObjects (co). """
-        if "UserAssist" in co1.cellpath:
-            return (co1.cellpath == co2.cellpath and
-                co1.name_type == co2.name_type and
-                co1.alloc == co2.alloc and
-                co1.data_type == co2.data_type and
-                co1.annos == co2.annos and
-                co1.app_state == co2.app_state)
-        return (co1.cellpath == co2.cellpath and
-                co1.name_type == co2.name_type and
-                co1.alloc == co2.alloc and
-                co1.data_type == co2.data_type and
-                co1.data == co2.data and
-                co1.annos == co2.annos and
-                co1.app_state == co2.app_state)
+        """ Compare two CellObjects (co) using the match policy. """
+        return self.policy.compare_cells(co1, co2)
 
     def stats(self, count):
-        fis = list(self.dfxml_obj)
-        cos = list(self.regxml_obj)
-        intersect_fis = [fi for fi in fis if fi.count == count + 1]
-        intersect_cos = [co for co in cos if co.count == count + 1]
-
+        # Objects with a count of count + 1, from the histograms
         cCOUNT = count + 1
-        cALL = sum(1 for x in intersect_fis) + sum(1 for x in intersect_cos)
-        cDIRS = len([fi for fi in intersect_fis if fi.meta_type == 2])
-        cFILES = len([fi for fi in intersect_fis if fi.meta_type == 1])
-        cKEYS = len([co for co in intersect_cos if co.name_type == "k"])
-        cVALUES = len([co for co in intersect_cos if co.name_type == "v"])
-
-        print("%s,%d,%d,%d,%s,%s \\\\ " % (self.order[count].name,
+        cALL = 0
+        for histogram in (self.file_histogram, self.cell_histogram):
+            cALL += sum(n for ((c, kind), n) in histogram.items() if c == cCOUNT)
+        cDIRS = self.file_histogram[(cCOUNT, 2)]
+        cFILES = self.file_histogram[(cCOUNT, 1)]
+        cKEYS = self.cell_histogram[(cCOUNT, "k")]
+        cVALUES = self.cell_histogram[(cCOUNT, "v")]
+
+        row = "%s,%d,%d,%d,%s,%s \\\\ " % (self.order[count].name,
               cDIRS,
               cFILES,
               cKEYS,
               "{:,}".format(cVALUES),
-              "{:,}".format(cALL)))
+              "{:,}".format(cALL))
+        if count < len(self.pass_stats):
+            self.pass_stats[count] = row
+        else:
+            self.pass_stats.append(row)
+        print(row)
 
     def csv_output(self, count):
         """ Create CSV output for intersected entries. """
         count += 1
         files_csv = "n" + str(count) + "_FILES.csv"
         cells_csv = "n" + str(count) + "_CELLS.csv"
-        # CSV for FILES
-        with open(files_csv, 'w') as f:
-            f.write("count,state,filename,delta,meta_type,alloc_name,alloc_inode,filesize,sha1\n")
-            for fi in self.dfxml_obj:
-                f.write("%s,%s,%s,%s,%s,%s,%s,%s,%s\n" % (fi.count,
-                                                          fi.app_state,
-                                                          fi.filename,
-                                                          "".join(fi.annos),
-                                                          fi.meta_type,
-                                                          fi.alloc_name,
-                                                          fi.alloc_inode,
-                                                          fi.filesize,
-                                                          fi.sha1))
-        # CSV for CELLS
-        with open(cells_csv, 'w') as f:
-            f.write("count,state,cellpath,delta,name_type,alloc,data_type,data\n")
-            for co in self.regxml_obj:
-                f.write("%s,%s,%s,%s,%s,%s,%s,%s\n" % (co.count,
-                                                       co.app_state,
-                                                       co.cellpath,
-                                                       "".join(fi.annos),
-                                                       co.name_type,
-                                                       co.alloc,
-                                                       co.data_type,
-                                                       co.data))
+        write_csv(files_csv, FILES_CSV_HEADER, (file_row(fi) for fi in self.dfxml_obj))
+        write_csv(cells_csv, CELLS_CSV_HEADER, (cell_row(co) for co in self.regxml_obj))
+
+    def csv_delta(self, count):
+        """ Create CSV output for the entries added or counted in the pass
+            of profile count, with their membership so far. """
+        bit = 1 << count
+        profiles = len(self.order)
+        count += 1
+        files_csv = "n" + str(count) + "_FILES_DELTA.csv"
+        cells_csv = "n" + str(count) + "_CELLS_DELTA.csv"
+        write_csv(files_csv, FILES_CSV_HEADER + ",membership",
+                  (file_row(fi, membership_string(fi.membership, profiles))
+                   for fi in self.dfxml_obj if fi.membership & bit))
+        write_csv(cells_csv, CELLS_CSV_HEADER + ",membership",
+                  (cell_row(co, membership_string(co.membership, profiles))
+                   for co in self.regxml_obj if co.membership & bit))
+
+    def csv_final(self):
+        """ Create one CSV output of all entries after the last pass, with
+            their membership. """
+        profiles = len(self.order)
+        files_csv = self.out_fn + "-n" + str(profiles) + "-FILES.csv"
+        cells_csv = self.out_fn + "-n" + str(profiles) + "-CELLS.csv"
+        write_csv(files_csv, FILES_CSV_HEADER + ",membership",
+                  (file_row(fi, membership_string(fi.membership, profiles))
+                   for fi in self.dfxml_obj))
+        write_csv(cells_csv, CELLS_CSV_HEADER + ",membership",
+                  (cell_row(co, membership_string(co.membership, profiles))
+                   for co in self.regxml_obj))
 
     def apxml_output(self, count):
         """ Create APXML output for intersected entries. """    
-
+        objs = [obj for obj in self.dfxml_obj if obj.count == count]
+        objs.extend([obj for obj in self.regxml_obj if obj.count == count])
+        # Set the file output name
+        fn = self.out_fn + "-n" + str(count) + "-INTERSECTION.apxml"
+        self.write_apxml(objs, fn)
+
+    def materialize(self, objs):
+        """ Replace ArtifactRecords with the objects they were made from,
+            parsing each source profile once. """
+        wanted = collections.OrderedDict()
+        for obj in objs:
+            if isinstance(obj, ArtifactRecord):
+                wanted.setdefault(obj.path, dict())[obj.position] = obj
+        found = dict()
+        for (path, records) in wanted.items():
+            for (position, obj) in enumerate(apxml.iterparse_objects(path)):
+                record = records.get(position)
+                if record is not None:
+                    obj.count = record.count
+                    obj.membership = record.membership
+                    found[id(record)] = obj
+        return [found.get(id(obj), obj) for obj in objs]
+
+    def write_apxml(self, objs, fn):
+        """ Write FileObjects and CellObjects to an APXML document, using
+            the header of the first profile. """
         apxml_out = self.profileList[0]
+        objs = self.materialize(objs)
 
         # Remove all files and cells from APXMLObject
         del apxml_out._files[:]
         del apxml_out._cells[:]
 
         # Append files and cells to new APXML
-        for fi in self.dfxml_obj:
-            if fi.count == count:
-                apxml_out.append(fi)
-        for cell in self.regxml_obj:
-            if cell.count == count:
-                apxml_out.append(cell)
+        for obj in objs:
+            apxml_out.append(obj)
 
         # Write a temp APXML document
         temp_fi = io.StringIO(apxml_out.to_apxml())
         # Format APXML using minidom
         xml_fi = xml.dom.minidom.parse(temp_fi)
         apxml_report = xml_fi.toprettyxml(indent="  ")
-        # Set the file output name
-        fn = self.out_fn + "-n" + str(count) + "-INTERSECTION.apxml"
         # Write out APXML document
         with open(fn, "w", encoding="utf-16-le") as f:
             #f.write("<?xml version='1.0' encoding='UTF-16' ?>")
@@ -299,31 +614,134 @@ formatter_class = argparse.RawTextHelpFormatter)
                         help = 'Application Profiles XML (APXML)',
                         nargs='+')
     parser.add_argument('mode',
-                        help = 'How to store APXML order (none, lowest, highest, stacked)')
+                        help = 'How to store APXML order (none, lowest, highest, stacked)\n(not used with --add)',
+                        nargs = '?')
+    parser.add_argument('--rules',
+                        help = 'JSON match rules file (replaces the default rules)',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--disable-rule',
+                        help = 'Name of a match rule to disable (lnk, prefetch, userassist)',
+                        action = 'append',
+                        default = [])
+    parser.add_argument('-j', '--jobs',
+                        help = 'Number of processes used to load profiles (default: 1)',
+                        action = 'store',
+                        type = int,
+                        default = 1)
+    parser.add_argument('--stream',
+                        help = 'Parse one profile at a time and keep only artifacts\nfound in every profile so far (no per-pass CSV output)',
+                        action = 'store_true')
+    parser.add_argument('--csv',
+                        help = 'CSV output: pass (every entry after each pass, default),\ndelta (entries of each pass, with membership),\nfinal (every entry after the last pass, with membership), none',
+                        choices = CSV_MODES,
+                        default = None)
+    parser.add_argument('--state',
+                        help = 'Intersection state file, written after the run',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--add',
+                        help = 'Fold the profiles into the existing --state file\n(no mode, profiles are added in argument order; the match\nrules and stream mode are those of the state)',
+                        action = 'store_true')
+    parser.add_argument('--min-profiles',
+                        help = 'Also write artifacts present in at least this many profiles',
+                        action = 'store',
+                        type = int,
+                        required = False)
+    parser.add_argument('--in-profiles',
+                        help = 'Also write artifacts present in these profiles\n(comma separated positions in processing order, from 1)',
+                        action = 'store',
+                        required = False)
     args = parser.parse_args()
 
-    obj = Intersection(args.profiles)
-
-    # Sort profiles based on total number or digital artifacts
-    # None = sorted based on argument position
-    # lowest = sorted based on low > high
-    # highest = sorted based on high > low
-    obj.sort_profiles(args.mode)
-
-    # Parse the first profile, and output
-    obj.first_pass()
-    print("profile_count,all,dirs,files,keys,values")
-    obj.stats(0)
-    obj.csv_output(0)
-
-    # Parse each subsequent profile, and output
-    count = 1
-    profileCount = len(args.profiles)
-    while count < profileCount:
-        obj.next_pass(count)
-        obj.stats(count)
-        obj.csv_output(count)
-        count += 1
+    # Use the classes of the imported module rather than those of
+    # __main__, so state files can be loaded by the module as well
+    import APXMLIntersection
+
+    # The profiles argument takes every positional, so the mode is last
+    if not args.add:
+        if len(args.profiles) < 2:
+            parser.error("the following arguments are required: mode")
+        args.mode = args.profiles.pop()
+    else:
+        if not args.state:
+            parser.error("--add needs a --state file")
+        for (flag, used) in [("--rules", args.rules),
+                             ("--disable-rule", args.disable_rule),
+                             ("-j/--jobs", args.jobs != 1),
+                             ("--stream", args.stream)]:
+            if used:
+                parser.error("%s cannot be used with --add, the state file keeps its own" % flag)
+
+    if args.add:
+        obj = APXMLIntersection.load_state(args.state)
+        stream = obj.stream
+    else:
+        rules = None
+        if args.rules:
+            rules = MatchPolicy.load_rules(args.rules)
+        policy = MatchPolicy.MatchPolicy(rules, args.disable_rule)
+        stream = args.stream
+
+    # Stream mode only keeps the entries found in every profile so far
+    if args.csv is None:
+        args.csv = "none" if stream else "pass"
+    if stream and args.csv in ["pass", "delta"]:
+        parser.error("stream mode only supports --csv final or none")
+
+    def pass_csv(obj, count):
+        if args.csv == "pass":
+            obj.csv_output(count)
+        elif args.csv == "delta":
+            obj.csv_delta(count)
+
+    if args.add:
+        # Reprint the stored passes, then fold in each new profile
+        print("profile_count,all,dirs,files,keys,values")
+        obj.print_stats()
+        for profile in args.profiles:
+            count = obj.add_profile(profile)
+            obj.stats(count)
+            pass_csv(obj, count)
+        count = len(obj.order)
+    else:
+        obj = APXMLIntersection.Intersection(args.profiles, policy, args.stream, args.jobs)
+
+        # Sort profiles based on total number or digital artifacts
+        # None = sorted based on argument position
+        # lowest = sorted based on low > high
+        # highest = sorted based on high > low
+        obj.sort_profiles(args.mode)
+
+        # Parse the first profile, and output
+        obj.first_pass()
+        print("profile_count,all,dirs,files,keys,values")
+        obj.stats(0)
+        pass_csv(obj, 0)
+
+        # Parse each subsequent profile, and output
+        count = 1
+        profileCount = len(args.profiles)
+        while count < profileCount:
+            obj.next_pass(count)
+            obj.stats(count)
+            pass_csv(obj, count)
+            count += 1
+
+    # Make a CSV document from final result
+    if args.csv == "final":
+        obj.csv_final()
 
     # Make an APXML document from final result
     obj.apxml_output(count)
+
+    # Make an APXML document from a membership query
+    if args.min_profiles is not None or args.in_profiles:
+        profiles = []
+        if args.in_profiles:
+            profiles = [int(i) - 1 for i in args.in_profiles.split(",")]
+        objs = list(obj.select(args.min_profiles, profiles))
+        obj.write_apxml(objs, obj.out_fn + "-QUERY.apxml")
+
+    if args.state:
+        obj.save_state(args.state)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Author:  Thomas Laurenson
+Email:   thomas@thomaslaurenson.com
+Website: thomaslaurenson.com
+Date:    2016/01/04
+
+Description:
+The APXMLNoiseFilter.py Python module removes operating system background
+noise from APXML documents. An index of artifact digests is built once
+from one or more baseline APXML documents (captured on an idle system),
+and saved to disk. Each profile is then streamed, and FileObjects and
+CellObjects found in the baseline index are dropped.
+
+Copyright (c) 2016, Thomas Laurenson
+
+###############################################################################
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+>>> CHANGELOG:
+    0.1.0       Base functionality ()
+
+"""
+
+import os
+import sys
+import json
+import array
+
+try:
+    import Objects
+except ImportError:
+    print("Error: APXMLNoiseFilter.py")
+    print("       The Objects.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import apxml
+except ImportError:
+    print("Error: APXMLNoiseFilter.py")
+    print("       The apxml.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import MatchPolicy
+except ImportError:
+    print("Error: APXMLNoiseFilter.py")
+    print("       The MatchPolicy.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+################################################################################
+# Index file: a magic line, a JSON header line, then for each category the
+# sorted 64-bit digests as little-endian unsigned integers
+INDEX_MAGIC = b"APXML-NOISE-INDEX 2\n"
+
+# Digest categories:
+#   path: normalised file path or cellpath (lower case)
+#   hash: SHA-1 of a file
+#   key: match key without application state (see MatchPolicy.py)
+CATEGORIES = ["path", "hash", "key"]
+
+def object_path(obj):
+    """ Normalised path of a FileObject or CellObject, falling back to the
+        raw path when the profile was not pre-processed. Lower case, as
+        neither file system nor Registry paths are case sensitive. """
+    if isinstance(obj, Objects.FileObject):
+        return (obj.filename_norm or obj.filename or "").lower()
+    return (obj.cellpath_norm or obj.cellpath or "").lower()
+
+################################################################################
+class NoiseIndex(object):
+    def __init__(self, rules=None, disabled=()):
+        """ Initialise an empty NoiseIndex. The match rules are stored in
+            the index, so profiles are filtered with the same keys. Baseline
+            and application profiles are captured in different states, so
+            keys leave the state out. """
+        self.rules = rules
+        self.disabled = list(disabled)
+        self.policy = MatchPolicy.MatchPolicy(rules, disabled, ignore_state=True)
+        self.digests = dict((category, set()) for category in CATEGORIES)
+
+    def object_digests(self, obj, categories=CATEGORIES):
+        """ Yield (category, digest) for each of the categories that applies
+            to an object. """
+        is_file = isinstance(obj, Objects.FileObject)
+        kind = "f" if is_file else "c"
+        if "path" in categories:
+            yield ("path", MatchPolicy.key_digest((kind, object_path(obj))))
+        if "hash" in categories and is_file and obj.sha1:
+            yield ("hash", MatchPolicy.key_digest(("h", obj.sha1.lower())))
+        if "key" in categories:
+            if is_file:
+                key = self.policy.file_key(obj)
+            else:
+                key = self.policy.cell_key(obj)
+            yield ("key", MatchPolicy.key_digest((kind,) + key))
+
+    def add_profile(self, profile):
+        """ Add every artifact of a baseline APXML document. """
+        for obj in apxml.iterparse_objects(profile):
+            for (category, digest) in self.object_digests(obj):
+                self.digests[category].add(digest)
+
+    def contains(self, obj, categories=("path",)):
+        """ Return True if an object is in the baseline for any of the
+            categories. """
+        for (category, digest) in self.object_digests(obj, categories):
+            if digest in self.digests[category]:
+                return True
+        return False
+
+    def save(self, fn):
+        """ Write the index to disk. """
+        header = {"rules": self.rules,
+                  "disabled": self.disabled,
+                  "categories": [[category, len(self.digests[category])] for category in CATEGORIES]}
+        with open(fn, "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for category in CATEGORIES:
+                digests = array.array("Q", sorted(self.digests[category]))
+                if sys.byteorder != "little":
+                    digests.byteswap()
+                digests.tofile(f)
+
+    @classmethod
+    def load(cls, fn):
+        """ Read an index written by save. """
+        with open(fn, "rb") as f:
+            if f.readline() != INDEX_MAGIC:
+                raise ValueError("Not an APXML noise index: %r." % fn)
+            header = json.loads(f.readline().decode("utf-8"))
+            index = cls(header["rules"], header["disabled"])
+            for (category, count) in header["categories"]:
+                digests = array.array("Q")
+                digests.fromfile(f, count)
+                if sys.byteorder != "little":
+                    digests.byteswap()
+                index.digests[category] = set(digests)
+        return index
+
+################################################################################
+def filter_profile(index, profile, fn, categories=("path",)):
+    """ Stream a profile to the APXML document fn, without the objects in
+        the baseline index. Returns a (kept, dropped) tuple of counts. """
+    counts = [0, 0]
+    apxml_obj = apxml.APXMLObject()
+
+    def kept():
+        for obj in apxml.iterparse_objects(profile, apxml_obj):
+            if index.contains(obj, categories):
+                counts[1] += 1
+            else:
+                counts[0] += 1
+                yield obj
+
+    with open(fn, "w", encoding="utf-16-le", buffering=1048576) as f:
+        apxml_obj.print_apxml(f, kept())
+    return tuple(counts)
+
+################################################################################
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='''APXMLNoiseFilter.py''',
+formatter_class = argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.required = True
+
+    build = subparsers.add_parser('build',
+                                  help = 'Build a noise index from baseline profiles')
+    build.add_argument('index',
+                       help = 'Noise index file to write')
+    build.add_argument('baselines',
+                       help = 'Baseline Application Profiles XML (APXML)',
+                       nargs='+')
+    build.add_argument('--rules',
+                       help = 'JSON match rules file for the key category',
+                       action = 'store',
+                       required = False)
+    build.add_argument('--disable-rule',
+                       help = 'Name of a match rule to disable (lnk, prefetch, userassist)',
+                       action = 'append',
+                       default = [])
+
+    filt = subparsers.add_parser('filter',
+                                 help = 'Drop baseline artifacts from profiles')
+    filt.add_argument('index',
+                      help = 'Noise index file')
+    filt.add_argument('profiles',
+                      help = 'Application Profiles XML (APXML)',
+                      nargs='+')
+    filt.add_argument('--by',
+                      help = 'Comma separated categories to match on (path, hash, key)\n(default: path)',
+                      action = 'store',
+                      default = 'path')
+    filt.add_argument('-o',
+                      help = 'Output directory (default: current directory)',
+                      action = 'store',
+                      default = '.')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        rules = None
+        if args.rules:
+            rules = MatchPolicy.load_rules(args.rules)
+        index = NoiseIndex(rules, args.disable_rule)
+        for baseline in args.baselines:
+            print("  > %s" % baseline)
+            index.add_profile(baseline)
+        index.save(args.index)
+        for category in CATEGORIES:
+            print("%s,%d" % (category, len(index.digests[category])))
+
+    elif args.command == 'filter':
+        categories = args.by.split(",")
+        for category in categories:
+            if category not in CATEGORIES:
+                parser.error("unknown category: %r" % category)
+        index = NoiseIndex.load(args.index)
+        print("profile,kept,dropped")
+        for profile in args.profiles:
+            fn = os.path.splitext(os.path.basename(profile))[0] + "-FILTERED.apxml"
+            (kept, dropped) = filter_profile(index, profile, os.path.join(args.o, fn), categories)
+            print("%s,%d,%d" % (profile, kept, dropped))
@@ -9,7 +9,8 @@ Date:    2016/01/04
 Description:
 The APXMLPreProcess.py Python module takes an APXML document as input
 and pre-processes the document for processing against a target data
-set.
+set. The document is streamed: each object is parsed, normalised and
+written before the next is read.
 
 Copyright (c) 2016, Thomas Laurenson
 
@@ -34,10 +35,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os
-import io
-import codecs
-import collections
-import xml.dom.minidom
+import sys
+import json
+import hashlib
+import itertools
 
 try:
     import dfxml
@@ -85,110 +86,159 @@ except ImportError:
     sys.exit(1)
 
 ################################################################################
-# Initialize the file path normalizer object
-file_path_normalizer = FilePathNormalizer.FilePathNormalizer()
-
-# Initialize the cell path normalizer object
-cell_path_normalizer = CellPathNormalizer.CellPathNormalizer()
-
-# Create DFMXL and RegXML Objects to store information
-dfxml = Objects.DFXMLObject()
-regxml = Objects.RegXMLObject()
-
-################################################################################
-def normalise_all(apxml_obj):
-    for obj in apxml_obj:
-        if isinstance(obj, Objects.FileObject):
-            # Add basename to FileObject
-            basename = obj.filename.split("\\")
-            obj.basename = basename[len(basename) - 1]
-
-            # Normalize the file path and append to FileObject
-            obj.filename_norm = file_path_normalizer.normalize(obj.filename)
-
-            # Use filename_norm to extract basename_norm
-            basename_norm = obj.filename_norm.split("/")
-            obj.basename_norm = basename_norm[len(basename_norm) - 1]
-
-            # LiveDiff stores SHA-1 hashes in uppercase, convert to lower
-            if obj.sha1 is not None:
-                obj.sha1 = obj.sha1.lower()
-
-            # Set the application name
-            obj.app_name = apxml_obj.metadata.app_name
-
-            # Add a orphan_name to only unallocated files
-            if not obj.is_allocated() and obj.meta_type == 1:
-                split = obj.filename.split("\\")
-                obj.orphan_name = "$OrphanFiles/" + split[len(split) - 1]
-
-            # All done, append to DFXMLObject
-            dfxml.append(obj)
-
-        elif isinstance(obj, Objects.CellObject):
-            # Normalize the cell path
-            obj.cellpath_norm = cell_path_normalizer.normalize_profile_co(obj.cellpath)
-            rootkey = obj.cellpath_norm.split("\\")[0]
-            obj.cellpath_norm = cell_path_normalizer.normalize_cellpath(obj.cellpath_norm, rootkey)
-            
-            # Set cellpath_norm to lower case (Registry paths are not case sensitive)
-            obj.cellpath_norm = obj.cellpath_norm.lower()
-            
-            # Normalize the basename
-            obj.basename_norm = None
-            if obj.basename and obj.basename.startswith("C:"):
-                normbasename = file_path_normalizer.normalize(obj.basename)
+# Number of objects whose paths are normalised together (see normalise_objects)
+CHUNK_SIZE = 1000
+
+class Preprocessor(object):
+    def __init__(self, rules=None, cache_size=4096):
+        """ Initialise Preprocessor object from a normalization rules
+            dictionary (see FilePathNormalizer.load_rules). One object can
+            pre-process any number of profiles, sharing the path caches. """
+        self.file_path_normalizer = FilePathNormalizer.FilePathNormalizer(rules, cache_size)
+        self.cell_path_normalizer = CellPathNormalizer.CellPathNormalizer(rules, cache_size)
+
+    def normalise_file(self, obj, app_name, filename_norm=None):
+        """ Normalise a FileObject in place. The normalised file path is
+            computed, unless given as filename_norm. """
+        # Add basename to FileObject
+        basename = obj.filename.split("\\")
+        obj.basename = basename[len(basename) - 1]
+
+        # Normalize the file path and append to FileObject
+        if filename_norm is None:
+            filename_norm = self.file_path_normalizer.normalize(obj.filename)
+        obj.filename_norm = filename_norm
+
+        # Use filename_norm to extract basename_norm
+        basename_norm = obj.filename_norm.split("/")
+        obj.basename_norm = basename_norm[len(basename_norm) - 1]
+
+        # LiveDiff stores SHA-1 hashes in uppercase, convert to lower
+        if obj.sha1 is not None:
+            obj.sha1 = obj.sha1.lower()
+
+        # Set the application name
+        obj.app_name = app_name
+
+        # Add a orphan_name to only unallocated files
+        if not obj.is_allocated() and obj.meta_type == 1:
+            split = obj.filename.split("\\")
+            obj.orphan_name = "$OrphanFiles/" + split[len(split) - 1]
+
+    def normalise_cell(self, obj, app_name, cellpath_norm=None):
+        """ Normalise a CellObject in place. The normalised cellpath is
+            computed, unless given as cellpath_norm (before lower casing). """
+        # Normalize the cell path
+        if cellpath_norm is None:
+            cellpath_norm = self.cell_path_normalizer.normalize_profile_co(obj.cellpath)
+            rootkey = cellpath_norm.split("\\")[0]
+            cellpath_norm = self.cell_path_normalizer.normalize_cellpath(cellpath_norm, rootkey)
+
+        # Set cellpath_norm to lower case (Registry paths are not case sensitive)
+        obj.cellpath_norm = cellpath_norm.lower()
+
+        # Normalize the basename
+        obj.basename_norm = None
+        if obj.basename and obj.basename.startswith("C:"):
+            normbasename = self.file_path_normalizer.normalize(obj.basename)
+            normbasename = normbasename.replace('/', '\\')
+            obj.basename_norm = normbasename
+            obj.cellpath_norm = obj.cellpath_norm.replace(obj.basename, obj.basename_norm)
+
+        elif obj.basename:
+            # Decode user assist entry (P:\..., HRZR_EHACNGU:P:\... or
+            # {GUID}\...) and normalise
+            normbasename = CellPathNormalizer.decode_userassist(obj.basename)
+            if normbasename is not None:
+                normbasename = self.file_path_normalizer.normalize(normbasename)
                 normbasename = normbasename.replace('/', '\\')
-                obj.basename_norm = normbasename
-                obj.cellpath_norm = obj.cellpath_norm.replace(obj.basename, obj.basename_norm)
-            
-            elif obj.basename and obj.basename.startswith("P:"):
-                # Decrypt user assist entry and normalise
-                normbasename = codecs.decode(obj.basename, "rot_13")
-                if normbasename.startswith("C:"):
-                    normbasename = file_path_normalizer.normalize(normbasename)
-                    normbasename = normbasename.replace('/', '\\')
-                    obj.basename_norm = normbasename.lower()
-                    obj.cellpath_norm = obj.cellpath_norm.replace(obj.basename.lower(), obj.basename_norm)
-                    
-            # Set the application name
-            obj.app_name = apxml_obj.metadata.app_name
-
-            # All done, append to RegXMLObject
-            regxml.append(obj)
-
-def apxml_output(apxml_obj, fn, output = False):
-    # Reconstruct APXML document
-    apxml_out = apxml_obj
-
-    # Remove all files and cells from APXMLObject
-    del apxml_out._files[:]
-    del apxml_out._cells[:]
-    
-    # Append files and cells to new APXML
-    for fi in dfxml:
-        apxml_out.append(fi)
-    for cell in regxml:
-        apxml_out.append(cell)
-
-    # Write a temp APXML document
-    temp_fi = io.StringIO(apxml_out.to_apxml())
-    # Format APXML using minidom
-    xml_fi = xml.dom.minidom.parse(temp_fi)
-    apxml_report = xml_fi.toprettyxml(indent="  ")
-    
-    if output:
-        out_fi = fn
-    else:
-        # Set the output filename based on profile
-        fn = os.path.basename(fn)
-        fn = os.path.splitext(fn)[0]
-        out_fi = fn + "-NORM.apxml"
-
-    # Write out APXML document
-    with open(out_fi, "w", encoding="utf-16-le") as f:
-        #f.write("<?xml version='1.0' encoding='UTF-16' ?>")
-        f.write(apxml_report)
+                obj.basename_norm = normbasename.lower()
+                obj.cellpath_norm = obj.cellpath_norm.replace(obj.basename.lower(), obj.basename_norm)
+
+        # Set the application name
+        obj.app_name = app_name
+
+    def normalise_objects(self, objects, apxml_obj):
+        """ Generator. Normalise and yield each FileObject and CellObject
+            of objects, with the application name of apxml_obj. Objects are
+            read in chunks of CHUNK_SIZE, and the paths of each chunk are
+            normalised together (see normalize_many), so objects can be
+            apxml.iterparse_objects(filename, apxml_obj). """
+        objects = iter(objects)
+        while True:
+            chunk = list(itertools.islice(objects, CHUNK_SIZE))
+            if not chunk:
+                return
+            app_name = apxml_obj.metadata.app_name
+            files = [obj for obj in chunk if isinstance(obj, Objects.FileObject)]
+            cells = [obj for obj in chunk if isinstance(obj, Objects.CellObject)]
+
+            filename_norms = self.file_path_normalizer.normalize_many([obj.filename for obj in files])
+            for (obj, filename_norm) in zip(files, filename_norms):
+                self.normalise_file(obj, app_name, filename_norm)
+
+            # Cellpaths are normalised together per root key
+            rootkeys = dict()
+            for obj in cells:
+                cellpath = self.cell_path_normalizer.normalize_profile_co(obj.cellpath)
+                rootkey = cellpath.split("\\")[0]
+                rootkeys.setdefault(rootkey, list()).append((obj, cellpath))
+            for (rootkey, members) in rootkeys.items():
+                cellpath_norms = self.cell_path_normalizer.normalize_many([cellpath for (obj, cellpath) in members], rootkey)
+                for ((obj, cellpath), cellpath_norm) in zip(members, cellpath_norms):
+                    self.normalise_cell(obj, app_name, cellpath_norm)
+
+            for obj in chunk:
+                yield obj
+
+    def preprocess(self, profile, fn):
+        """ Stream a profile to the normalised APXML document fn. Returns
+            the number of objects written. """
+        count = [0]
+        apxml_obj = apxml.APXMLObject()
+
+        def counted(objects):
+            for obj in objects:
+                count[0] += 1
+                yield obj
+
+        objects = apxml.iterparse_objects(profile, apxml_obj)
+        with open(fn, "w", encoding="utf-16-le", buffering=1048576) as f:
+            apxml_obj.print_apxml(f, counted(self.normalise_objects(objects, apxml_obj)))
+        return count[0]
+
+def normalise_all(apxml_obj, preprocessor=None):
+    """ Normalise the objects of an APXMLObject in place. """
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+    for obj in preprocessor.normalise_objects(apxml_obj, apxml_obj):
+        pass
+
+def rules_version(rules=None):
+    """ Return the version of the normalization: the normalizer module
+        versions and a digest of the rules dictionary (default: the default
+        rules) and the UserAssist known folders. A profile normalised with
+        another version is out of date. """
+    if rules is None:
+        rules = FilePathNormalizer.DEFAULT_RULES
+    data = json.dumps([rules, CellPathNormalizer.USERASSIST_FOLDERS], sort_keys=True).encode("utf-8")
+    return "%s-%s-%s" % (FilePathNormalizer.__version__,
+                         CellPathNormalizer.__version__,
+                         hashlib.blake2b(data, digest_size=8).hexdigest())
+
+def norm_filename(profile, output_dir="."):
+    """ Return the default output file name of a profile:
+        <output_dir>/<profile name>-NORM.apxml """
+    fn = os.path.splitext(os.path.basename(profile))[0]
+    return os.path.join(output_dir, fn + "-NORM.apxml")
+
+def preprocess(profile, fn=None, rules=None):
+    """ Pre-process a profile to the APXML document fn (default: see
+        norm_filename), using normalization rules (default: the default
+        rules). Returns the number of objects written. """
+    if fn is None:
+        fn = norm_filename(profile)
+    return Preprocessor(rules).preprocess(profile, fn)
 
 ################################################################################
 if __name__=='__main__':
@@ -201,17 +251,15 @@ formatter_class = argparse.RawTextHelpFormatter)
                         help = 'APXML Output',
                         action = 'store',
                         required = False,)
+    parser.add_argument('--rules',
+                        help = 'JSON normalization rules file (see FilePathNormalizer.py)',
+                        action = 'store',
+                        required = False)
     args = parser.parse_args()
 
-    # Read the APXML profile, then generate stats
-    apxml_obj = apxml.iterparse(args.profile)
-    apxml.generate_stats(apxml_obj)
-
-    # Normalise the APXML document and all entries
-    normalise_all(apxml_obj)
-    
-    # Generate APXML output (the normalised profile)
-    if args.o:
-        apxml_output(apxml_obj, args.o, output = True)
-    else:
-        apxml_output(apxml_obj, args.profile)
+    rules = None
+    if args.rules:
+        rules = FilePathNormalizer.load_rules(args.rules)
+
+    # Stream the normalised profile to the APXML output
+    preprocess(args.profile, args.o, rules)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Author:  Thomas Laurenson
+Email:   thomas@thomaslaurenson.com
+Website: thomaslaurenson.com
+Date:    2016/01/04
+
+Description:
+The APXMLSetOps.py Python module computes the union, difference and
+symmetric difference of two or more APXML documents. Artifacts are the
+same when their match keys (see MatchPolicy.py) are equal. Profiles are
+streamed, and only 64-bit key digests are held in memory.
+
+Copyright (c) 2016, Thomas Laurenson
+
+###############################################################################
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+>>> CHANGELOG:
+    0.1.0       Base functionality ()
+
+"""
+
+import os
+import sys
+
+try:
+    import Objects
+except ImportError:
+    print("Error: APXMLSetOps.py")
+    print("       The Objects.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import apxml
+except ImportError:
+    print("Error: APXMLSetOps.py")
+    print("       The apxml.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import MatchPolicy
+except ImportError:
+    print("Error: APXMLSetOps.py")
+    print("       The MatchPolicy.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+################################################################################
+def object_digest(obj, policy):
+    """ Return (kind, digest) for an object: kind is 0 for a FileObject and
+        1 for a CellObject, digest is the digest of its match key. """
+    if isinstance(obj, Objects.FileObject):
+        return (0, MatchPolicy.key_digest(policy.file_key(obj)))
+    return (1, MatchPolicy.key_digest(policy.cell_key(obj)))
+
+def _policy(policy):
+    # Artifacts are compared across profiles of different application
+    # states, so the default key leaves the state out
+    if policy is None:
+        return MatchPolicy.MatchPolicy(ignore_state=True)
+    return policy
+
+################################################################################
+def union(profiles, policy=None, apxml_obj=None):
+    """ Generator. Yields the first object of every artifact in any of the
+        profiles, in profile order. The header of the first profile is
+        populated on apxml_obj, if given. """
+    policy = _policy(policy)
+    seen = (set(), set())
+    for (i, profile) in enumerate(profiles):
+        header = apxml_obj if i == 0 else None
+        for obj in apxml.iterparse_objects(profile, header):
+            (kind, digest) = object_digest(obj, policy)
+            if digest not in seen[kind]:
+                seen[kind].add(digest)
+                yield obj
+
+def difference(profiles, policy=None, apxml_obj=None):
+    """ Generator. Yields the objects of the first profile whose artifact
+        is in none of the other profiles, once per artifact. The header of
+        the first profile is populated on apxml_obj, if given. """
+    policy = _policy(policy)
+    # Artifacts already yielded are excluded too
+    excluded = (set(), set())
+    for profile in profiles[1:]:
+        for obj in apxml.iterparse_objects(profile):
+            (kind, digest) = object_digest(obj, policy)
+            excluded[kind].add(digest)
+    for obj in apxml.iterparse_objects(profiles[0], apxml_obj):
+        (kind, digest) = object_digest(obj, policy)
+        if digest not in excluded[kind]:
+            excluded[kind].add(digest)
+            yield obj
+
+def symmetric_difference(profiles, policy=None, apxml_obj=None):
+    """ Generator. Yields the objects of artifacts found in exactly one of
+        the profiles, once per artifact, in profile order. With two
+        profiles this is the usual symmetric difference. The header of the
+        first profile is populated on apxml_obj, if given. """
+    policy = _policy(policy)
+    # First pass: digest -> index of the only profile holding it, or -1
+    owners = (dict(), dict())
+    for (i, profile) in enumerate(profiles):
+        for obj in apxml.iterparse_objects(profile):
+            (kind, digest) = object_digest(obj, policy)
+            if owners[kind].setdefault(digest, i) != i:
+                owners[kind][digest] = -1
+    # Second pass: yield the first object of each single-profile artifact
+    for (i, profile) in enumerate(profiles):
+        header = apxml_obj if i == 0 else None
+        for obj in apxml.iterparse_objects(profile, header):
+            (kind, digest) = object_digest(obj, policy)
+            if owners[kind][digest] == i:
+                owners[kind][digest] = None
+                yield obj
+
+OPERATIONS = {"union": union,
+              "difference": difference,
+              "symdiff": symmetric_difference}
+
+def write_setop(operation, profiles, fn, policy=None):
+    """ Stream the result of an operation (a key of OPERATIONS) over the
+        profiles to the APXML document fn, with the header of the first
+        profile. """
+    apxml_obj = apxml.APXMLObject()
+    objects = OPERATIONS[operation](profiles, policy, apxml_obj)
+    with open(fn, "w", encoding="utf-16-le", buffering=1048576) as f:
+        apxml_obj.print_apxml(f, objects)
+
+################################################################################
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='''APXMLSetOps.py''',
+formatter_class = argparse.RawTextHelpFormatter)
+    parser.add_argument('operation',
+                        help = 'union: artifacts in any profile\ndifference: artifacts in the first profile only\nsymdiff: artifacts in exactly one profile',
+                        choices = sorted(OPERATIONS))
+    parser.add_argument('profiles',
+                        help = 'Application Profiles XML (APXML), two or more',
+                        nargs='+')
+    parser.add_argument('-o',
+                        help = 'Output APXML file (default: <first profile>-<OPERATION>.apxml)',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--rules',
+                        help = 'JSON match rules file (replaces the default rules)',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--disable-rule',
+                        help = 'Name of a match rule to disable (lnk, prefetch, userassist)',
+                        action = 'append',
+                        default = [])
+    parser.add_argument('--match-state',
+                        help = 'Also compare application state and annotations (default: ignored)',
+                        action = 'store_true',
+                        default = False)
+    args = parser.parse_args()
+
+    if len(args.profiles) < 2:
+        parser.error("at least two profiles are required")
+
+    rules = None
+    if args.rules:
+        rules = MatchPolicy.load_rules(args.rules)
+    policy = MatchPolicy.MatchPolicy(rules, args.disable_rule,
+                                     ignore_state=not args.match_state)
+
+    fn = args.o
+    if fn is None:
+        fn = os.path.splitext(os.path.basename(args.profiles[0]))[0]
+        fn += "-" + args.operation.upper() + ".apxml"
+
+    write_setop(args.operation, args.profiles, fn, policy)
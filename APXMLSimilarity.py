@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Author:  Thomas Laurenson
+Email:   thomas@thomaslaurenson.com
+Website: thomaslaurenson.com
+Date:    2016/01/04
+
+Description:
+The APXMLSimilarity.py Python module computes the pairwise Jaccard
+similarity of APXML documents over the match keys of their artifacts,
+separately for FileObjects and CellObjects. The output is a similarity
+matrix CSV for files and one for cells, suitable for clustering.
+
+Copyright (c) 2016, Thomas Laurenson
+
+###############################################################################
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+>>> CHANGELOG:
+    0.1.0       Base functionality ()
+
+"""
+
+import os
+import sys
+import heapq
+import itertools
+import concurrent.futures
+
+try:
+    import Objects
+except ImportError:
+    print("Error: APXMLSimilarity.py")
+    print("       The Objects.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import apxml
+except ImportError:
+    print("Error: APXMLSimilarity.py")
+    print("       The apxml.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+try:
+    import MatchPolicy
+except ImportError:
+    print("Error: APXMLSimilarity.py")
+    print("       The MatchPolicy.py module is required to run this script")
+    print("       You can download from: https://github.com/thomaslaurenson/apxml")
+    print("       Now Exiting...")
+    sys.exit(1)
+
+################################################################################
+def profile_sketch(profile, policy, minhash=None):
+    """ Parse a profile and return a (files, cells) tuple of the digests of
+        its match keys. Each is a frozenset, or with minhash, a MinHash
+        (bottom-k) sketch: the minhash smallest digests, as a frozenset. """
+    files = set()
+    cells = set()
+    for obj in apxml.iterparse_objects(profile):
+        if isinstance(obj, Objects.FileObject):
+            files.add(MatchPolicy.key_digest(policy.file_key(obj)))
+        elif isinstance(obj, Objects.CellObject):
+            cells.add(MatchPolicy.key_digest(policy.cell_key(obj)))
+    if minhash is not None:
+        files = heapq.nsmallest(minhash, files)
+        cells = heapq.nsmallest(minhash, cells)
+    return (frozenset(files), frozenset(cells))
+
+def jaccard(a, b):
+    """ Jaccard similarity of two sets of digests. Two empty sets are
+        identical. """
+    union = len(a | b)
+    if union == 0:
+        return 1.0
+    return len(a & b) / union
+
+def jaccard_minhash(a, b, minhash):
+    """ Estimate the Jaccard similarity of two profiles from their bottom-k
+        sketches: the share of the k smallest digests of the union that are
+        in both sketches. """
+    union = heapq.nsmallest(minhash, a | b)
+    if not union:
+        return 1.0
+    both = a & b
+    return sum(1 for digest in union if digest in both) / len(union)
+
+def pair_similarity(a, b, minhash=None):
+    """ Similarity of two sketches: exact Jaccard, or with minhash, the
+        MinHash estimate. """
+    if minhash is None:
+        return jaccard(a, b)
+    return jaccard_minhash(a, b, minhash)
+
+# Sketches of every profile, set once in each worker process by init_worker
+_sketches = None
+
+def init_worker(sketches):
+    global _sketches
+    _sketches = sketches
+
+def similarity_row(i, minhash=None):
+    """ Return a (files, cells) tuple of the similarities of profile i to
+        every later profile, from the sketches set by init_worker. """
+    files = list()
+    cells = list()
+    for j in range(i + 1, len(_sketches)):
+        files.append(pair_similarity(_sketches[i][0], _sketches[j][0], minhash))
+        cells.append(pair_similarity(_sketches[i][1], _sketches[j][1], minhash))
+    return (files, cells)
+
+def similarity_matrix(rows):
+    """ Return the symmetric matrix (list of lists) built from the upper
+        triangle rows of similarity_row, with 1.0 on the diagonal. """
+    count = len(rows)
+    matrix = [[1.0] * count for i in range(count)]
+    for (i, row) in enumerate(rows):
+        for (j, value) in enumerate(row, i + 1):
+            matrix[i][j] = matrix[j][i] = value
+    return matrix
+
+def similarity(profiles, policy=None, minhash=None, jobs=None):
+    """ Compute the file and cell similarity matrices of a list of APXML
+        profiles. Profiles are parsed, then the rows of the matrices are
+        computed, in parallel using jobs processes (default: one per CPU).
+        Returns a (files, cells) tuple of matrices, with rows and columns in
+        the order of profiles. """
+    if policy is None:
+        policy = MatchPolicy.MatchPolicy(ignore_state=True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        sketches = list(executor.map(profile_sketch,
+                                     profiles,
+                                     itertools.repeat(policy),
+                                     itertools.repeat(minhash)))
+    # A new pool sends the sketches once to each worker, not once per row
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                initializer=init_worker,
+                                                initargs=(sketches,)) as executor:
+        rows = list(executor.map(similarity_row,
+                                 range(len(sketches)),
+                                 itertools.repeat(minhash)))
+    files = similarity_matrix([row[0] for row in rows])
+    cells = similarity_matrix([row[1] for row in rows])
+    return (files, cells)
+
+def write_matrix(fn, names, matrix):
+    """ Write a similarity matrix to a CSV file, with a header row and a
+        first column of profile names. """
+    with open(fn, "w") as f:
+        f.write("profile," + ",".join(names) + "\n")
+        for (name, row) in zip(names, matrix):
+            f.write(name + "," + ",".join("%.4f" % value for value in row) + "\n")
+
+################################################################################
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='''APXMLSimilarity.py''',
+formatter_class = argparse.RawTextHelpFormatter)
+    parser.add_argument('profiles',
+                        help = 'Application Profiles XML (APXML)',
+                        nargs='+')
+    parser.add_argument('-o',
+                        help = 'Output file name prefix (default: similarity)',
+                        action = 'store',
+                        default = 'similarity')
+    parser.add_argument('-j', '--jobs',
+                        help = 'Number of processes used to parse and compare profiles (default: one per CPU)',
+                        action = 'store',
+                        type = int,
+                        required = False)
+    parser.add_argument('--minhash',
+                        help = 'Estimate similarity from MinHash (bottom-k) sketches of this size',
+                        action = 'store',
+                        type = int,
+                        required = False)
+    parser.add_argument('--rules',
+                        help = 'JSON match rules file (replaces the default rules)',
+                        action = 'store',
+                        required = False)
+    parser.add_argument('--disable-rule',
+                        help = 'Name of a match rule to disable (lnk, prefetch, userassist)',
+                        action = 'append',
+                        default = [])
+    parser.add_argument('--match-state',
+                        help = 'Also compare application state and annotations (default: ignored)',
+                        action = 'store_true',
+                        default = False)
+    args = parser.parse_args()
+
+    rules = None
+    if args.rules:
+        rules = MatchPolicy.load_rules(args.rules)
+    policy = MatchPolicy.MatchPolicy(rules, args.disable_rule,
+                                     ignore_state=not args.match_state)
+
+    (files, cells) = similarity(args.profiles, policy, args.minhash, args.jobs)
+
+    names = [os.path.splitext(os.path.basename(profile))[0] for profile in args.profiles]
+    write_matrix(args.o + "-FILES.csv", names, files)
+    write_matrix(args.o + "-CELLS.csv", names, cells)
@@ -30,9 +30,12 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ###############################################################################
 """
 
-__version__ = "1.0.0"
+__version__ = "1.1.0"
 
-import codecs
+import sys
+import string
+import functools
+import collections
 
 try:
     import FilePathNormalizer
@@ -43,25 +46,93 @@ except ImportError:
     print('       Now Exiting...')
     sys.exit(1)
 
+################################################################################
+# ROT13 translation table: UserAssist value names are ROT13 encoded
+_ROT13 = str.maketrans(string.ascii_lowercase + string.ascii_uppercase,
+                       string.ascii_lowercase[13:] + string.ascii_lowercase[:13] +
+                       string.ascii_uppercase[13:] + string.ascii_uppercase[:13])
+
+# Known folders that Windows 7 (and newer) UserAssist paths start with,
+# e.g., {6D809377-6AF0-444B-8957-A3773F02200E}\TrueCrypt\TrueCrypt.exe
+USERASSIST_FOLDERS = {
+    "{6D809377-6AF0-444B-8957-A3773F02200E}": "Program Files",
+    "{905E63B6-C1BF-494E-B29C-65B732D3D21A}": "Program Files",
+    "{7C5A40EF-A0FB-4BFC-874A-C0F2E0B9FA8E}": "Program Files (x86)",
+    "{F38BF404-1D43-42F2-9305-67DE0B28FC23}": "Windows",
+    "{1AC14E77-02E7-4E5D-B744-2EB1AE5198B7}": "Windows\\System32",
+    "{D65231B0-B2F1-4857-A4CE-A8E7C6EA7D27}": "Windows\\SysWOW64",
+    "{0139D44E-6AFE-49F2-8690-3DAFCAE6FFB8}": "ProgramData\\Microsoft\\Windows\\Start Menu\\Programs",
+    "{A77F5D77-2E2B-44C3-A6A2-ABA601054A51}": "Users\\%USERNAME%\\AppData\\Roaming\\Microsoft\\Windows\\Start Menu\\Programs"
+}
+
+def rot13(value):
+    """ Decode (or encode) a ROT13 string. """
+    return value.translate(_ROT13)
+
+@functools.lru_cache(maxsize=4096)
+def decode_userassist(basename):
+    """ Decode the file system path of a UserAssist value name, or return
+        None if the name is not a UserAssist path. Handles the forms:
+            P:\... (C:\...)
+            HRZR_EHACNGU:P:\... (UEME_RUNPATH:C:\..., Windows XP)
+            {GUID}\... (known folder, Windows 7 and newer) """
+    if basename.startswith("P:"):
+        return rot13(basename)
+    if basename.startswith("HRZR_EHACNGU:"):
+        return rot13(basename[13:])
+    if basename.startswith("{") and len(basename) > 38 and basename[38] == "\\":
+        folder = USERASSIST_FOLDERS.get(rot13(basename[:38]).upper())
+        if folder is not None:
+            return folder + rot13(basename[38:])
+    return None
+
 ################################################################################
 class CellPathNormalizer():
-    def __init__(self):
-        """ Initialise CellPathNormalizer object. """
-        self.file_path_normalizer = FilePathNormalizer.FilePathNormalizer()
+    def __init__(self, rules=None, cache_size=4096):
+        """ Initialise CellPathNormalizer object from a rules dictionary
+            (see FilePathNormalizer.load_rules), using its "cells" rules,
+            and its "files" rules for paths in basenames. Normalized parent
+            keys (and file parent directories) are kept in LRU caches of
+            cache_size entries (0 disables them). """
+        if rules is None:
+            rules = FilePathNormalizer.DEFAULT_RULES
+        self.file_path_normalizer = FilePathNormalizer.FilePathNormalizer(rules, cache_size)
         self.active_rootkey = None
+        cells = rules.get("cells", {})
+        self.hives = [(hive["prefix"], hive.get("replace", ""), hive.get("strip_user", False))
+                      for hive in cells.get("hives", [])]
+        # rootkey -> {segment index: {key name: replacement}}, so a cellpath
+        # is normalized with one lookup per segment, whatever the rule count
+        self.segments = dict()
+        for rule in cells.get("segments", []):
+            names = self.segments.setdefault(rule["rootkey"], dict()).setdefault(rule["index"], dict())
+            for name in rule["names"]:
+                names.setdefault(name, rule["replace"])
+        # The last segment index a rule can replace
+        self._last_segment = max([index for rootkey in self.segments for index in self.segments[rootkey]] + [0])
+        self._parent_cache = None
+        if cache_size:
+            self._parent_cache = functools.lru_cache(maxsize=cache_size)(self._normalize_cellpath)
+
+    def cache_info(self):
+        """ Return the hits, misses and size of the parent key cache, or
+            None if it is disabled. """
+        if self._parent_cache is None:
+            return None
+        return self._parent_cache.cache_info()
 
     def normalize_profile_co(self, cellpath):
         """ Normalize the cellpath of the Profile CellObject (PCO). """
         normpath = cellpath
         # Remove Registry hive naming convention
-        if normpath.startswith("HKLM\\"):
-            normpath = normpath[5:]
-        if normpath.startswith("HKU\\"):
-            normpath = normpath[4:]
-            normpath = normpath.split("\\")
-            del normpath[0]
-            normpath = "\\".join(normpath)
-            normpath = "NTUSER.DAT\\" + normpath
+        for (prefix, replace, strip_user) in self.hives:
+            if normpath.startswith(prefix):
+                normpath = normpath[len(prefix):]
+                if strip_user:
+                    normpath = normpath.split("\\")
+                    del normpath[0]
+                    normpath = "\\".join(normpath)
+                normpath = replace + normpath
         return normpath
 
     def normalize_rootkey(self, cellpath, rootkey):
@@ -80,27 +151,61 @@ class CellPathNormalizer():
             return cellpath
 
     def normalize_cellpath(self, cellpath, rootkey):
-        """ Normalize the cellpath of the Target CellObject (TCO). """
-        
+        """ Normalize the cellpath of the Target CellObject (TCO). When no
+            rule can replace the last segment, this is the normalized parent
+            key (from the cache) plus the basename. """
+        if self._parent_cache is None:
+            return self._normalize_cellpath(cellpath, rootkey)
+        i = self._parent_index(cellpath)
+        if i == -1:
+            return self._normalize_cellpath(cellpath, rootkey)
+        return self._parent_cache(cellpath[:i], rootkey) + cellpath[i:]
+
+    def _parent_index(self, cellpath):
+        """ Return the index of the separator before the last segment of a
+            cellpath, or -1 if a rule could replace the last segment. """
+        if not cellpath or cellpath.count("\\") <= self._last_segment:
+            return -1
+        return cellpath.rfind("\\")
+
+    def normalize_many(self, cellpaths, rootkey):
+        """ Normalize a sequence of cellpaths of Target CellObjects (TCOs)
+            with the same rootkey, and return a list of the results in
+            input order. Cellpaths are grouped by parent key, so each parent
+            key, and each repeated cellpath, is normalized once. """
+        results = list()
+        groups = collections.OrderedDict()
+        for (index, cellpath) in enumerate(cellpaths):
+            results.append(None)
+            i = self._parent_index(cellpath)
+            if i == -1:
+                results[index] = self._normalize_cellpath(cellpath, rootkey)
+            else:
+                groups.setdefault(cellpath[:i], list()).append((index, cellpath[i:]))
+
+        normalize_parent = self._parent_cache or self._normalize_cellpath
+        for (parent, members) in groups.items():
+            normpath = normalize_parent(parent, rootkey)
+            for (index, basename) in members:
+                results[index] = normpath + basename
+        return results
+
+    def _normalize_cellpath(self, cellpath, rootkey):
+        """ Normalize a cellpath in full. """
+
         # Split a cellpath on backslashes, or return if None
         if cellpath:
             normpath = cellpath.split("\\")
         else:
             return cellpath
 
-        # System hive normalisation
-        if rootkey == "system":
-            control_names = ["controlset001",
-                             "controlset002",
-                             "controlset003",
-                             "currentcontrolset",
-                             "clone"]
-            # If path has "control set" name, normalise target path
-            # See: http://support.microsoft.com/kb/100010
-            #for name in control_names:
-            if len(normpath) >= 2:
-                if normpath[1] in control_names:
-                    normpath[1] = "%controlset%"
+        # Hive normalisation, e.g., the "control set" name of the system
+        # hive, see: http://support.microsoft.com/kb/100010
+        segments = self.segments.get(rootkey)
+        if segments:
+            for (index, names) in segments.items():
+                if index < len(normpath) and normpath[index] in names:
+                    normpath[index] = names[normpath[index]]
 
         # Join the split normalised path and return
         normpath = "\\".join(normpath)
@@ -109,28 +214,24 @@ class CellPathNormalizer():
     def normalize_basename(self, basename):
         """ If the basename is a path, normalize using the normalize function
             from the FilePathNormalizer module. """
-       
-        basename_norm = None
-        
-        # Decrypt a UserAssist entry ('P:' equates to 'C:' using rot13) 
-        if basename.startswith("P:"):
-            basename_norm = codecs.decode(obj.basename, "rot_13")
-   
-        # Strip UserAssist prefix in older windows versions
-        elif basename.startswith("HRZR_EHACNGU"):
-            basename_norm = basename[12:]
-        
-        else:
+        return self.file_path_normalizer.normalize(self._basename_path(basename))
+
+    def normalize_basenames(self, basenames):
+        """ Normalize a sequence of basenames (see normalize_basename), and
+            return a list of the results in input order. """
+        paths = [self._basename_path(basename) for basename in basenames]
+        return self.file_path_normalizer.normalize_many(paths)
+
+    def _basename_path(self, basename):
+        """ Decode a UserAssist entry, and convert a basename to a path for
+            the file path normalizer. """
+        basename_norm = decode_userassist(basename)
+        if basename_norm is None:
             basename_norm = basename
-    
+
         # If basename_norm starts with C:
         if basename_norm.startswith("C:"):
             basename_norm = basename_norm[3:]
-        
-        # Replace backslash with forward slash
-        basename_norm = basename_norm.replace('\\', '/')
-        
-        # Now normlaise using file path normaliser modules
-        basename_norm = self.file_path_normalizer.normalize(basename_norm)
 
-        return basename_norm
+        # Replace backslash with forward slash
+        return basename_norm.replace('\\', '/')
@@ -32,94 +32,286 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 __version__ = "1.0.0"
 
+import json
+import functools
 import collections
 
+################################################################################
+# Stands in for the basename when a parent directory is normalized, it
+# cannot be part of a rule name
+_PLACEHOLDER = "\x00"
+
+
+# Default rules, in the format of a rules file. Each variable replaces any
+# of its paths at the start of a file path, and later occurrences of the
+# same path. Variables apply in order, each to the path as rewritten by
+# the variables before it. An action also rewrites the rest of the path:
+#   prefetch: remove the hash suffix of a Prefetch file name
+#   userprofile: remove the user name after the variable
+# The "cells" rules are used by CellPathNormalizer.py.
+DEFAULT_RULES = {
+    "files": [
+        {"name": "programfiles",    "paths": ["Program Files",
+                                              "Program Files (x86)"]},
+        {"name": "allusersprofile", "paths": ["Documents and Settings/All Users",
+                                              "ProgramData",
+                                              "Users/Public"]},
+        {"name": "userprofile",     "paths": ["Users",
+                                              "Documents and Settings"],
+                                    "action": "userprofile"},
+        {"name": "localappdata",    "paths": ["%USERPROFILE%/Local Settings/Application Data",
+                                              "%USERPROFILE%/AppData/Local"]},
+        {"name": "appdata",         "paths": ["%USERPROFILE%/Application Data",
+                                              "%USERPROFILE%/AppData/Roaming"]},
+        {"name": "startmenu",       "paths": ["%ALLUSERSPROFILE%/Start Menu",
+                                              "%ALLUSERSPROFILE%/Microsoft/Windows/Start Menu",
+                                              "%APPDATA%/Microsoft/Windows/Start Menu",
+                                              "%USERPROFILE%/Start Menu",
+                                              "%USERPROFILE%/%APPDATA%/Microsoft/Windows/Start Menu"]},
+        {"name": "windir",          "paths": ["Windows",
+                                              "WINDOWS"]},
+        {"name": "systemroot",      "paths": ["%WINDIR%/system32",
+                                              "%WINDIR%/System32"]},
+        {"name": "prefetch",        "paths": ["%WINDIR%/prefetch",
+                                              "%WINDIR%/Prefetch"],
+                                    "action": "prefetch"}
+    ],
+    "cells": {
+        # Remove the hive prefix. For HKU, also remove the user SID and
+        # refer to the user hive
+        "hives": [
+            {"prefix": "HKLM\\", "replace": ""},
+            {"prefix": "HKU\\", "replace": "NTUSER.DAT\\", "strip_user": True}
+        ],
+        # Replace a key name found at a segment index in a hive
+        # See: http://support.microsoft.com/kb/100010
+        "segments": [
+            {"rootkey": "system", "index": 1, "replace": "%controlset%",
+             "names": ["controlset001",
+                       "controlset002",
+                       "controlset003",
+                       "currentcontrolset",
+                       "clone"]}
+        ]
+    }
+}
+
+ACTIONS = ["prefetch", "userprofile"]
+
+def load_rules(filename):
+    """ Read normalization rules from a JSON rules file. The file holds a
+        "files" list of variables, each with a "name", a list of "paths"
+        and an optional "action", and/or a "cells" object (see
+        CellPathNormalizer.py). Missing sections are taken from the
+        default rules. """
+    with open(filename) as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict):
+        raise ValueError("Expecting a JSON object in rules file: %r." % filename)
+    for section in DEFAULT_RULES:
+        rules.setdefault(section, DEFAULT_RULES[section])
+    return rules
+
+def _radix_node(node):
+    """ Convert a character trie node, a dictionary of child nodes with the
+        stages ending at the node under _PLACEHOLDER, to a radix trie node.
+        A radix trie node is a (stages, edges) tuple, where edges maps the
+        first character of an edge label to a (label, node) tuple. Chains
+        of nodes without stages or branches are merged into one edge. """
+    edges = dict()
+    for (char, child) in node.items():
+        if char == _PLACEHOLDER:
+            continue
+        label = char
+        while len(child) == 1 and not _PLACEHOLDER in child:
+            (char, child) = next(iter(child.items()))
+            label += char
+        edges[label[0]] = (label, _radix_node(child))
+    return (tuple(node.get(_PLACEHOLDER, ())), edges)
+
 ################################################################################
 class FilePathNormalizer():
-    def __init__(self):
-        """ Initialise FilePathNormalizer object. """
+    def __init__(self, rules=None, cache_size=4096):
+        """ Initialise FilePathNormalizer object from a rules dictionary
+            (see load_rules). Normalized parent directories are kept in an
+            LRU cache of cache_size entries (0 disables it). """
+        if rules is None:
+            rules = DEFAULT_RULES
+        self.cache_size = cache_size
         self.variable_paths = collections.OrderedDict()
-        self.variable_paths["programfiles"]    = ["Program Files",
-                                                  "Program Files (x86)"]
-        self.variable_paths["allusersprofile"] = ["Documents and Settings/All Users",
-                                                  "ProgramData",
-                                                  "Users/Public"]
-        self.variable_paths["userprofile"]     = ["Users",
-                                                  "Documents and Settings"]
-        self.variable_paths["localappdata"]    = ["%USERPROFILE%/Local Settings/Application Data",
-                                                  "%USERPROFILE%/AppData/Local"]
-        self.variable_paths["appdata"]         = ["%USERPROFILE%/Application Data",
-                                                  "%USERPROFILE%/AppData/Roaming"]
-        self.variable_paths["startmenu"]       = ["%ALLUSERSPROFILE%/Start Menu",
-                                                  "%ALLUSERSPROFILE%/Microsoft/Windows/Start Menu",
-                                                  "%APPDATA%/Microsoft/Windows/Start Menu",
-                                                  "%USERPROFILE%/Start Menu",
-                                                  "%USERPROFILE%/%APPDATA%/Microsoft/Windows/Start Menu"]
-        self.variable_paths["windir"]          = ["Windows",
-                                                  "WINDOWS"]
-        self.variable_paths["systemroot"]      = ["%WINDIR%/system32",
-                                                  "%WINDIR%/System32"]
-        self.variable_paths["prefetch"]        = ["%WINDIR%/prefetch",
-                                                  "%WINDIR%/Prefetch"]
+        self.variable_actions = dict()
+        for variable in rules.get("files", []):
+            if variable.get("action") not in ACTIONS + [None]:
+                raise ValueError("Unknown action in rule: %r." % variable)
+            self.variable_paths[variable["name"]] = list(variable["paths"])
+            self.variable_actions[variable["name"]] = variable.get("action")
+        self.compile()
+
+    def compile(self):
+        """ Compile variable_paths into an ordered list of stages, one per
+            (key, name) pair in table order, and a radix trie of the stage
+            names. One walk along a path finds the next stage to apply, so
+            the cost does not grow with the number of rules. Also resets
+            the parent directory cache. """
+        self._stages = list()
+        trie = dict()
+        for key in self.variable_paths:
+            for name in self.variable_paths[key]:
+                if not name or _PLACEHOLDER in name:
+                    raise ValueError("Invalid path in rule %r: %r." % (key, name))
+                node = trie
+                for char in name:
+                    node = node.setdefault(char, dict())
+                node.setdefault(_PLACEHOLDER, list()).append(len(self._stages))
+                self._stages.append((name, "%" + key.upper() + "%", self.variable_actions.get(key)))
+        self._trie = _radix_node(trie)
+
+        names = [stage[0] for stage in self._stages]
+        self._name_prefixes = set(name[:i] for name in names for i in range(len(name)))
+
+        self._parent_cache = None
+        if self.cache_size:
+            self._parent_cache = functools.lru_cache(maxsize=self.cache_size)(self._normalize_parent)
+
+    def cache_info(self):
+        """ Return the hits, misses and size of the parent directory cache,
+            or None if it is disabled. """
+        if self._parent_cache is None:
+            return None
+        return self._parent_cache.cache_info()
 
     def normalize(self, fullpath):
-        """ Normalize a logical file system path value of a target file. """
+        """ Normalize a logical file system path value of a target file.
+            The normalized parent directory is looked up in the cache, and
+            the basename appended. Paths the rules could treat differently
+            from their parent are normalized in full. """
+        if self._parent_cache is None:
+            return self._normalize(fullpath)
+        i = max(fullpath.rfind("\\"), fullpath.rfind("/")) + 1
+        if i == 0:
+            return self._normalize(fullpath)
+        prefix = fullpath[:i]
+        return self._append_basename(prefix, self._parent_cache(prefix), fullpath[i:])
+
+    def normalize_many(self, paths):
+        """ Normalize a sequence of paths, and return a list of the results
+            in input order. Paths are grouped by parent directory, so each
+            parent directory, and each repeated path, is normalized once. """
+        results = list()
+        groups = collections.OrderedDict()
+        for (index, fullpath) in enumerate(paths):
+            results.append(None)
+            i = max(fullpath.rfind("\\"), fullpath.rfind("/")) + 1
+            groups.setdefault(fullpath[:i], list()).append((index, fullpath[i:]))
+
+        normalize_parent = self._parent_cache or self._normalize_parent
+        for (prefix, members) in groups.items():
+            if prefix:
+                parent = normalize_parent(prefix)
+            done = dict()
+            for (index, basename) in members:
+                if basename not in done:
+                    if prefix:
+                        done[basename] = self._append_basename(prefix, parent, basename)
+                    else:
+                        done[basename] = self._normalize(basename)
+                results[index] = done[basename]
+        return results
+
+    def _append_basename(self, prefix, parent, basename):
+        """ Append a basename to its normalized parent directory, as
+            returned by _normalize_parent, or normalize the path in full
+            if the rules could treat it differently from its parent. """
+        (normpath, prefetch, names, tails) = parent
+        if normpath is None or \
+          (prefetch and basename.endswith(".pf")) or \
+          basename.startswith(tails):
+            return self._normalize(prefix + basename)
+        for name in names:
+            if name in basename:
+                return self._normalize(prefix + basename)
+        return normpath + basename
+
+    def _normalize_parent(self, prefix):
+        """ Normalize a parent directory (with its trailing separator) for
+            the cache. Returns the normalized prefix, whether a prefetch
+            rule applied, and the names and last name segments of the
+            applied rules, which must not appear in (or start) a basename
+            as the rules also replace later occurrences of a name. The
+            prefix is None if the basename could change which rules
+            apply. """
+        states = list()
+        applied = list()
+        normpath = self._normalize(prefix + _PLACEHOLDER, states, applied)
+        for state in states:
+            # A rule name could continue into the basename
+            if not _PLACEHOLDER in state or state[:state.index(_PLACEHOLDER)] in self._name_prefixes:
+                return (None, False, (), ())
+        # The userprofile rule can remove the basename segment
+        if not normpath.endswith(_PLACEHOLDER) or normpath.count(_PLACEHOLDER) != 1:
+            return (None, False, (), ())
+        names = tuple(stage[0] for stage in applied)
+        tails = tuple(name.split("/")[-1] for name in names if "/" in name)
+        prefetch = any(stage[2] == "prefetch" for stage in applied)
+        return (normpath[:-1], prefetch, names, tails)
+
+    def _match(self, fullpath, start):
+        """ Return the index of the first stage from start on whose name
+            is a prefix of fullpath, or None. """
+        (stages, edges) = self._trie
+        position = 0
+        match = None
+        while edges:
+            edge = edges.get(fullpath[position:position + 1])
+            if edge is None or not fullpath.startswith(edge[0], position):
+                break
+            position += len(edge[0])
+            (stages, edges) = edge[1]
+            for i in stages:
+                if i >= start:
+                    if match is None or i < match:
+                        match = i
+                    break
+        return match
+
+    def _normalize(self, fullpath, states=None, applied=None):
+        """ Normalize a path in full. The path before each stage lookup is
+            appended to states, and each applied stage to applied, if
+            given. """
         # Check root directory
         if fullpath.startswith("C:\\"):
             fullpath = fullpath[3:]
 
         # Check/replace backslash characters in path
-        temp = fullpath.split("\\")
-        fullpath = "/".join(temp)
+        fullpath = fullpath.replace("\\", "/")
 
-        # Now, normalize full path
-        for key in self.variable_paths:
-            for name in self.variable_paths[key]:
-                # Normalize Program Files path
-                if key == "programfiles":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%PROGRAMFILES%")
-                # Normalize All Users path
-                elif key == "allusersprofile":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%ALLUSERSPROFILE%")
-                # Normalize Local App Data path
-                elif key == "localappdata":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%LOCALAPPDATA%")
-                
-                # Normalize Windows directory path
-                if key == "windir":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%WINDIR%")
-                # Normalize Windows System Root path
-                if key == "systemroot":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%SYSTEMROOT%")
-                # Normalize Windows Prefecth path (and filename)
-                if key == "prefetch":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%PREFETCH%")
-                        # Also normalise prefetch name (remove random number
-                        # string suffix to allow path matching)
-                        if fullpath.endswith(".pf"):
-                            index = fullpath.index(".pf") - 9
-                            fullpath = fullpath[0:index] + ".pf"
-                # Normalize User Profile path (home directory)
-                if key == "userprofile":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%USERPROFILE%")
-                        fullpath = fullpath.split("/")
-                        # Remove <username> then re-join path string
-                        if len(fullpath) > 1:
-                            del fullpath[1]
-                        fullpath = '/'.join(fullpath)
-                # Normalize Local App Data path
-                if key == "appdata":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%APPDATA%")
-                # Normalize Start Menu path
-                if key == "startmenu":
-                    if fullpath.startswith(name):
-                        fullpath = fullpath.replace(name, "%STARTMENU%")
+        # Now, normalize full path. Stages apply in table order, and each
+        # sees the path as rewritten by the stages before it
+        i = 0
+        while i < len(self._stages):
+            if states is not None:
+                states.append(fullpath)
+            i = self._match(fullpath, i)
+            if i is None:
+                break
+            (name, variable, action) = self._stages[i]
+            if applied is not None:
+                applied.append(self._stages[i])
+            # Replace the prefix, and any later occurrence of the name
+            fullpath = variable + fullpath[len(name):].replace(name, variable)
+            # Normalize Windows Prefecth path (and filename)
+            if action == "prefetch":
+                # Also normalise prefetch name (remove random number
+                # string suffix to allow path matching)
+                if fullpath.endswith(".pf"):
+                    index = fullpath.index(".pf") - 9
+                    fullpath = fullpath[0:index] + ".pf"
+            # Normalize User Profile path (home directory)
+            elif action == "userprofile":
+                fullpath = fullpath.split("/")
+                # Remove <username> then re-join path string
+                if len(fullpath) > 1:
+                    del fullpath[1]
+                fullpath = '/'.join(fullpath)
+            i += 1
         return fullpath
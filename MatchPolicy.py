@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""
+Author:  Thomas Laurenson
+Email:   thomas@thomaslaurenson.com
+Website: thomaslaurenson.com
+Date:    2016/01/04
+
+Description:
+The MatchPolicy.py Python module builds match keys for FileObjects and
+CellObjects. Two objects match when their keys are equal. Match rules
+(e.g., ignore the SHA-1 of shortcut files) are compiled once into key
+functions, so each object is only inspected when its key is computed.
+
+Copyright (c) 2016, Thomas Laurenson
+
+###############################################################################
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+>>> CHANGELOG:
+    0.1.0       Base functionality ()
+    0.1.1       Added ignore_state option for state-free match keys
+
+"""
+
+import os
+import json
+import hashlib
+import operator
+
+################################################################################
+# Properties compared between two objects. The first property is the path
+# that rules are matched against and transforms are applied to.
+FILE_PROPERTIES = ["filename",
+                   "meta_type",
+                   "sha1",
+                   "alloc_inode",
+                   "alloc_name",
+                   "annos",
+                   "app_state"]
+
+CELL_PROPERTIES = ["cellpath",
+                   "name_type",
+                   "alloc",
+                   "data_type",
+                   "data",
+                   "annos",
+                   "app_state"]
+
+# Properties describing the state an object was captured in, rather than
+# the object itself. Set operations and baselines compare across states.
+STATE_PROPERTIES = ["annos",
+                    "app_state"]
+
+def prefetch_path(path):
+    """ Normalize Prefetch file for comparison, e.g.,
+        Before: C:\\Windows\\Prefetch\\TRUECRYPT.EXE-009A2E5A.pf
+        After:  C:\\Windows\\Prefetch\\TRUECRYPT.EXE """
+    path = os.path.splitext(path)[0]
+    return path.split("-")[0]
+
+# Path transforms that rules can refer to by name
+TRANSFORMS = {"prefetch": prefetch_path,
+              "lower": str.lower}
+
+# Default rules, in the format of a rules file. For each object type, the
+# first rule that matches an object's path is applied.
+DEFAULT_RULES = {
+    "files": [
+        # Do not compare SHA-1 hash value of ShortCut (lnk) files
+        {"name": "lnk", "suffix": ".lnk", "ignore": ["sha1"]},
+        # Strip the Prefetch hash suffix, do not compare SHA-1
+        {"name": "prefetch", "suffix": ".pf", "ignore": ["sha1"], "transform": "prefetch"}
+    ],
+    "cells": [
+        # Do not compare UserAssist data, it changes on every run
+        {"name": "userassist", "contains": "UserAssist", "ignore": ["data"]}
+    ]
+}
+
+def load_rules(filename):
+    """ Read match rules from a JSON rules file. The file holds a "files"
+        and/or a "cells" list of rules. Each rule has a "name", a "suffix"
+        or "contains" string matched against the object path, an "ignore"
+        list of properties, and an optional "transform" name. """
+    with open(filename) as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict):
+        raise ValueError("Expecting a JSON object in rules file: %r." % filename)
+    return rules
+
+def key_digest(key):
+    """ Return a 64-bit integer digest of a match key. Unlike hash(), it is
+        the same in every process and run, so digests of different profiles
+        can be compared or stored. """
+    parts = list()
+    for part in key:
+        if isinstance(part, frozenset):
+            part = "|".join(sorted(part))
+        parts.append(str(part))
+    data = "\x1f".join(parts).encode("utf-8", "surrogatepass")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+################################################################################
+class MatchRule(object):
+    def __init__(self, properties, name="", suffix=None, contains=None,
+                 ignore=(), transform=None):
+        """ Compile one rule into a key function for its matching objects. """
+        for prop in ignore:
+            if prop not in properties[1:]:
+                raise ValueError("Rule %r cannot ignore property %r." % (name, prop))
+        if transform is not None and transform not in TRANSFORMS:
+            raise ValueError("Rule %r has unknown transform %r." % (name, transform))
+
+        self.name = name
+        self.suffix = suffix
+        self.contains = contains
+        self.transform = TRANSFORMS.get(transform)
+
+        self._path = operator.attrgetter(properties[0])
+        self._annos = "annos" not in ignore and "annos" in properties
+        fields = [p for p in properties[1:] if p not in ignore and p != "annos"]
+        # Always return a tuple, attrgetter returns a scalar for one name
+        if len(fields) > 1:
+            self._fields = operator.attrgetter(*fields)
+        elif len(fields) == 1:
+            getter = operator.attrgetter(fields[0])
+            self._fields = lambda obj: (getter(obj),)
+        else:
+            self._fields = lambda obj: ()
+
+    def matches(self, path):
+        """ Return True if this rule applies to an object with this path. """
+        if self.suffix is not None and not path.endswith(self.suffix):
+            return False
+        if self.contains is not None and self.contains not in path:
+            return False
+        return True
+
+    def key(self, obj):
+        """ Return the match key of an object under this rule. """
+        path = self._path(obj)
+        if self.transform is not None:
+            path = self.transform(path)
+        if self._annos:
+            return (self.name, path, frozenset(obj.annos)) + self._fields(obj)
+        return (self.name, path) + self._fields(obj)
+
+################################################################################
+class MatchPolicy(object):
+    def __init__(self, rules=None, disabled=(), ignore_state=False):
+        """ Initialise MatchPolicy object from a rules dictionary (see
+            load_rules). Rules named in disabled are skipped. If ignore_state
+            is True, keys do not include the STATE_PROPERTIES, so the same
+            object matches in every application state. """
+        if rules is None:
+            rules = DEFAULT_RULES
+        self._args = (rules, tuple(disabled), ignore_state)
+        file_properties = FILE_PROPERTIES
+        cell_properties = CELL_PROPERTIES
+        if ignore_state:
+            file_properties = [p for p in FILE_PROPERTIES if p not in STATE_PROPERTIES]
+            cell_properties = [p for p in CELL_PROPERTIES if p not in STATE_PROPERTIES]
+        self.file_rules = self._compile(file_properties, rules.get("files", []), disabled)
+        self.cell_rules = self._compile(cell_properties, rules.get("cells", []), disabled)
+        self.file_default = MatchRule(file_properties)
+        self.cell_default = MatchRule(cell_properties)
+
+    def __reduce__(self):
+        """ Pickle the rules, not the compiled key functions, so a policy
+            can be sent to worker processes. """
+        return (MatchPolicy, self._args)
+
+    def _compile(self, properties, rules, disabled):
+        compiled = list()
+        names = set([""])
+        for rule in rules:
+            if rule.get("name") in disabled:
+                continue
+            # The rule name is part of the key, so it must be unique
+            if rule.get("name", "") in names:
+                raise ValueError("Rules need a unique, non-empty name: %r." % rule)
+            names.add(rule["name"])
+            # A rule may ignore state properties the key already leaves out
+            ignore = [p for p in rule.get("ignore", [])
+                      if p in properties or p not in STATE_PROPERTIES]
+            compiled.append(MatchRule(properties,
+                                      name=rule.get("name", ""),
+                                      suffix=rule.get("suffix"),
+                                      contains=rule.get("contains"),
+                                      ignore=ignore,
+                                      transform=rule.get("transform")))
+        return compiled
+
+    def _key(self, rules, default, path, obj):
+        for rule in rules:
+            if rule.matches(path):
+                return rule.key(obj)
+        return default.key(obj)
+
+    def _probes(self, rules, obj, key):
+        """ A rule is chosen by the path of the object already held, so a
+            new object also matches held objects whose rule transforms
+            their path to its own transformed path. """
+        probes = [key]
+        for rule in rules:
+            if rule.transform is not None:
+                probe = rule.key(obj)
+                if probe != key:
+                    probes.append(probe)
+        return probes
+
+    def file_key(self, fi):
+        """ Match key a FileObject (fi) is stored under. """
+        return self._key(self.file_rules, self.file_default, fi.filename, fi)
+
+    def cell_key(self, co):
+        """ Match key a CellObject (co) is stored under. """
+        return self._key(self.cell_rules, self.cell_default, co.cellpath, co)
+
+    def file_probes(self, fi, key):
+        """ Keys of the held FileObjects that a new FileObject (fi), stored
+            under key, matches. """
+        return self._probes(self.file_rules, fi, key)
+
+    def cell_probes(self, co, key):
+        """ Keys of the held CellObjects that a new CellObject (co), stored
+            under key, matches. """
+        return self._probes(self.cell_rules, co, key)
+
+    def compare_files(self, fi1, fi2):
+        """ Return True if a new FileObject (fi2) matches a FileObject (fi1). """
+        return self.file_key(fi1) in self.file_probes(fi2, self.file_key(fi2))
+
+    def compare_cells(self, co1, co2):
+        """ Return True if a new CellObject (co2) matches a CellObject (co1). """
+        return self.cell_key(co1) in self.cell_probes(co2, self.cell_key(co2))
+
+if __name__=="__main__":
+    import pickle
+    import Objects
+
+    install = Objects.FileObject()
+    install.filename = "C:\\Program Files\\TrueCrypt\\TrueCrypt.exe"
+    install.sha1 = "4e1243bd22c66e76c2ba9eddc1f91394e57f9f83"
+    install.app_state = "install"
+    install.annos = {"new"}
+    uninstall = Objects.FileObject()
+    uninstall.filename = install.filename
+    uninstall.sha1 = install.sha1
+    uninstall.app_state = "uninstall"
+    uninstall.annos = {"deleted"}
+
+    policy = MatchPolicy()
+    assert policy.file_key(install) != policy.file_key(uninstall)
+    policy = MatchPolicy(ignore_state=True)
+    assert policy.file_key(install) == policy.file_key(uninstall)
+    assert policy.compare_files(install, uninstall)
+    uninstall.sha1 = "0000000000000000000000000000000000000000"
+    assert not policy.compare_files(install, uninstall)
+
+    # Rules ignoring a state property still compile without state
+    rules = {"cells": [{"name": "state", "contains": "Run", "ignore": ["app_state", "data"]}]}
+    policy = MatchPolicy(rules, ignore_state=True)
+    assert pickle.loads(pickle.dumps(policy))._args == policy._args
+
+    # A baseline artifact is filtered from an application profile
+    import APXMLNoiseFilter
+    baseline = Objects.CellObject()
+    baseline.cellpath = "HKLM\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Run\\Updater"
+    baseline.data = "C:\\Updater.exe"
+    baseline.app_state = "baseline"
+    profile = Objects.CellObject()
+    profile.cellpath = baseline.cellpath
+    profile.data = baseline.data
+    profile.app_state = "install"
+    profile.annos = {"modified"}
+    index = APXMLNoiseFilter.NoiseIndex()
+    for (category, digest) in index.object_digests(baseline):
+        index.digests[category].add(digest)
+    assert index.contains(profile, ("key",))
+    profile.data = "C:\\TrueCrypt.exe"
+    assert not index.contains(profile, ("key",))
+
+    print("\nUnit tests passed.\n")
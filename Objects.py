@@ -21,6 +21,7 @@ import dfxml
 import os
 import sys
 import struct
+import datetime
 
 _logger = logging.getLogger(os.path.basename(__file__))
 
@@ -49,6 +50,58 @@ def _ET_tostring(e):
     else:
         return ET.tostring(e, encoding="unicode")
 
+def _xml_escape(text):
+    """Escapes element text the way ElementTree does."""
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+def _xml_escape_attrib(text):
+    """Escapes an attribute value the way ElementTree does."""
+    text = _xml_escape(text)
+    if "\"" in text:
+        text = text.replace("\"", "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+def _xml_text_element(parts, name, text, attribs=""):
+    """Appends the serialized element to the list parts.  text must be a string or None; attribs is pre-serialized attribute text."""
+    if text:
+        parts.append("<%s%s>%s</%s>" % (name, attribs, _xml_escape(text), name))
+    else:
+        parts.append("<%s%s />" % (name, attribs))
+
+def _xml_time_element(parts, name, value):
+    """Appends a TimestampObject, serialized as TimestampObject.to_Element() would produce it under the tag name, to the list parts."""
+    attribs = ""
+    if value.prec:
+        attribs = ' prec="%s"' % _xml_escape_attrib("%d%s" % value.prec)
+    _xml_text_element(parts, name, str(value.time) if value.time else None, attribs)
+
+def _write_buffered(output_fh, texts, buffer_size=1048576):
+    """Writes each string from the iterable texts, newline-terminated, to output_fh.  Strings are joined and written in chunks of about buffer_size characters."""
+    buf = []
+    size = 0
+    for text in texts:
+        buf.append(text)
+        buf.append("\n")
+        size += len(text) + 1
+        if size >= buffer_size:
+            output_fh.write("".join(buf))
+            buf = []
+            size = 0
+    if buf:
+        output_fh.write("".join(buf))
+
 def _boolcast(val):
     """Takes Boolean values, and 0 or 1 in string or integer form, and casts them all to Boolean.  Preserves nulls.  Balks at everything else."""
     if val is None:
@@ -73,6 +126,40 @@ def _bytecast(val):
         return val
     return _strcast(val).encode("utf-8")
 
+def _hexcast(val):
+    """Casts a value as a byte string.  Character strings are read as hexadecimal text, optionally whitespace-separated (e.g. "54 00 72 00").  Preserves nulls."""
+    if val is None:
+        return None
+    if isinstance(val, bytes):
+        return val
+    if isinstance(val, bytearray):
+        return bytes(val)
+    if isinstance(val, str):
+        try:
+            return bytes.fromhex(val)
+        except ValueError:
+            _logger.debug("val = " + repr(val))
+            raise ValueError("Received a non-hex-castable value.  Expected bytes or hexadecimal text.")
+    _logger.debug("val = " + repr(val))
+    raise TypeError("Expecting bytes or hexadecimal text.  Got instead this type: %r." % type(val))
+
+def _hexstr(val):
+    """Formats a byte string as space-separated uppercase hexadecimal text, the LiveDiff data_raw format.  Preserves nulls."""
+    if val is None:
+        return None
+    return val.hex(" ").upper()
+
+#FILETIME values are 100ns intervals since 1601-01-01.  Only values between 1970-01-01 and 2100-01-01 are decoded, since 8-byte binary data outside that range is unlikely to be a timestamp.
+_FILETIME_EPOCH = datetime.datetime(1601, 1, 1)
+_FILETIME_MIN = 116444736000000000
+_FILETIME_MAX = 157469184000000000
+
+def _filetimecast(val):
+    """Casts a FILETIME integer to a datetime.  Returns None for nulls and implausible values."""
+    if val is None or not _FILETIME_MIN <= val < _FILETIME_MAX:
+        return None
+    return _FILETIME_EPOCH + datetime.timedelta(microseconds=val // 10)
+
 def _intcast(val):
     """Casts input integer or string to integer.  Preserves nulls.  Balks at everything else."""
     if val is None:
@@ -214,10 +301,7 @@ class DFXMLObject(object):
             v.print_dfxml(output_fh)
             output_fh.write("\n")
         _logger.debug("Writing %d file objects." % len(self._files))
-        for f in self._files:
-            e = f.to_Element()
-            output_fh.write(_ET_tostring(e))
-            output_fh.write("\n")
+        _write_buffered(output_fh, (f.to_dfxml() for f in self._files))
         output_fh.write(dfxml_foot)
         output_fh.write("\n")
 
@@ -403,6 +487,7 @@ class RegXMLObject(object):
         output_fh.write("\n")
         for hive in self._hives:
             hive.print_regxml(output_fh)
+        _write_buffered(output_fh, (c.to_regxml() for c in self._cells))
         output_fh.write(regxml_foot)
         output_fh.write("\n")
 
@@ -626,10 +711,7 @@ class VolumeObject(object):
         output_fh.write(dfxml_head)
         output_fh.write("\n")
         _logger.debug("Writing %d file objects for this volume." % len(self._files))
-        for f in self._files:
-            e = f.to_Element()
-            output_fh.write(_ET_tostring(e))
-            output_fh.write("\n")
+        _write_buffered(output_fh, (f.to_dfxml() for f in self._files))
         output_fh.write(dfxml_foot)
         output_fh.write("\n")
 
@@ -896,9 +978,7 @@ class HiveObject(object):
         output_fh.write(xml_head)
         output_fh.write("\n")
 
-        for cell in self._cells:
-            output_fh.write(cell.to_regxml())
-            output_fh.write("\n")
+        _write_buffered(output_fh, (c.to_regxml() for c in self._cells))
 
         output_fh.write(xml_foot)
         output_fh.write("\n")
@@ -2161,7 +2241,77 @@ class FileObject(object):
         return outel
 
     def to_dfxml(self):
-        return _ET_tostring(self.to_Element())
+        """Serializes this FileObject to a string, identical to _ET_tostring(self.to_Element()).  Common objects are written directly as text without building an Element; objects with diffs, byte runs, externals, or original or parent objects fall back to to_Element()."""
+        if self.diffs or self.externals or \
+          self.data_brs or self.inode_brs or self.name_brs or \
+          not self.original_fileobject is None or \
+          not self.parent_object is None or \
+          not self.annos <= FileObject._diff_attr_names.keys():
+            return _ET_tostring(self.to_Element())
+
+        attribs = "".join(' %s="1"' % FileObject._diff_attr_names[annodiff] for annodiff in FileObject._diff_attr_names if annodiff in self.annos)
+        parts = []
+
+        def _str(name, value):
+            if not value is None:
+                _xml_text_element(parts, name, str(value))
+
+        def _bool(name, value):
+            if not value is None:
+                parts.append("<%s>%d</%s>" % (name, 1 if value else 0, name))
+
+        def _time(name, value):
+            if not value is None:
+                if value.time:
+                    _xml_time_element(parts, value.name, value)
+                else:
+                    parts.append("<%s />" % name)
+
+        def _hash(name, value):
+            if not value is None:
+                _xml_text_element(parts, "hashdigest", value, ' type="%s"' % name)
+
+        _str("filename", self.filename)
+        _str("filename_norm", self.filename_norm)
+        _str("basename", self.basename)
+        _str("basename_norm", self.basename_norm)
+        _str("error", self.error)
+        _str("partition", self.partition)
+        _str("id", self.id)
+        _str("name_type", self.name_type)
+        _str("filesize", self.filesize)
+        if self.alloc_name is None and self.alloc_inode is None:
+            _bool("alloc", self.alloc)
+        else:
+            _bool("alloc_inode", self.alloc_inode)
+            _bool("alloc_name", self.alloc_name)
+        _bool("used", self.used)
+        _bool("orphan", self.orphan)
+        _str("orphan_name", self.orphan_name)
+        _bool("compressed", self.compressed)
+        _str("inode", self.inode)
+        _str("meta_type", self.meta_type)
+        _str("mode", self.mode)
+        _str("nlink", self.nlink)
+        _str("uid", self.uid)
+        _str("gid", self.gid)
+        _time("mtime", self.mtime)
+        _time("ctime", self.ctime)
+        _time("atime", self.atime)
+        _time("crtime", self.crtime)
+        _str("seq", self.seq)
+        _time("dtime", self.dtime)
+        _time("bkup_time", self.bkup_time)
+        _str("link_target", self.link_target)
+        _str("libmagic", self.libmagic)
+        _hash("md5", self.md5)
+        _hash("sha1", self.sha1)
+        _str("app_name", self.app_name)
+        _str("app_state", self.app_state)
+
+        if not parts:
+            return "<fileobject%s />" % attribs
+        return "<fileobject%s>%s</fileobject>" % (attribs, "".join(parts))
 
     @property
     def alloc(self):
@@ -2692,6 +2842,16 @@ class CellObject(object):
       "annos"
     ])
 
+    #Fixed-width value types decoded from data_raw: data_type -> (struct format, data_conversions key).  REG_BINARY is only decoded when it is exactly 8 bytes long and holds a plausible FILETIME.
+    _data_raw_formats = {
+      "REG_DWORD":("<I", "int"),
+      "REG_DWORD_LITTLE_ENDIAN":("<I", "int"),
+      "REG_DWORD_BIG_ENDIAN":(">I", "int"),
+      "REG_QWORD":("<Q", "int"),
+      "REG_QWORD_LITTLE_ENDIAN":("<Q", "int"),
+      "REG_BINARY":("<Q", "filetime")
+    }
+
     def __init__(self, *args, **kwargs):
         #These properties must be assigned first for sanity check dependencies
         self.name_type = kwargs.get("name_type")
@@ -2755,6 +2915,33 @@ class CellObject(object):
 
         return diffs
 
+    def decode_data_raw(self):
+        """Decodes data_raw according to data_type into data_conversions ("int", "string", "string_list" or "filetime").  Returns data_conversions.  To decode many cells at once, use apxml.decode_cells()."""
+        raw = self.data_raw
+        if raw is None:
+            return self.data_conversions
+        if self.data_type in CellObject._data_raw_formats:
+            (fmt, key) = CellObject._data_raw_formats[self.data_type]
+            if len(raw) == struct.calcsize(fmt):
+                self.set_data_conversion(key, struct.unpack(fmt, raw)[0])
+        elif self.data_type in ["REG_SZ", "REG_EXPAND_SZ"]:
+            value = raw.decode("utf-16-le", errors="replace")
+            self.set_data_conversion("string", value.split("\x00", 1)[0])
+        elif self.data_type == "REG_MULTI_SZ":
+            value = raw.decode("utf-16-le", errors="replace")
+            self.set_data_conversion("string_list", [s for s in value.split("\x00") if s])
+        return self.data_conversions
+
+    def set_data_conversion(self, key, value):
+        """Stores one decoded value in data_conversions.  "filetime" values are FILETIME integers; they are stored as datetimes, or dropped if implausible."""
+        if key == "filetime":
+            value = _filetimecast(value)
+            if value is None:
+                return
+        if self.data_conversions is None:
+            self.data_conversions = dict()
+        self.data_conversions[key] = value
+
     def populate_from_Element(self, e):
         """Populates this CellObject's properties from an ElementTree Element.  The Element need not be retained."""
         global _warned_elements
@@ -2798,12 +2985,19 @@ class CellObject(object):
                 self.data_encoding = ce.text
             # TL: Added raw data element to be populated
             elif ctn == "data_raw":
-                self.data_raw = ce.text
+                # A malformed value should not abort parsing the profile
+                try:
+                    self.data_raw = ce.text
+                except ValueError:
+                    _logger.warning("Ignoring malformed data_raw in a CellObject: %r." % ce.text)
+                    self.data_raw = None
             elif ctn == "data_conversions":
                 self.data_conversions = dict()
                 for cce in ce:
                     if cce.tag == "int":
-                        self.data_conversions["int"] = int()
+                        self.data_conversions["int"] = int(cce.text)
+                    elif cce.tag == "filetime":
+                        self.data_conversions["filetime"] = datetime.datetime.strptime(cce.text, "%Y-%m-%dT%H:%M:%SZ")
                     elif cce.tag == "string":
                         self.data_conversions["string"] = cce.text
                     elif cce.tag == "string_list":
@@ -2924,7 +3118,7 @@ class CellObject(object):
         _append_object("mtime", self.mtime)
         _append_str("data_type", self.data_type)
         _append_str("data", self.data)
-        _append_str("data_raw", self.data_raw) # TL: Added data_raw to XML out
+        _append_str("data_raw", _hexstr(self.data_raw)) # TL: Added data_raw to XML out
         _append_str("app_name", self.app_name) # TL: Added app_name to XML out
         _append_str("app_state", self.app_state) # TL: Added app_state to XML out
         _append_str("rootkey", self.rootkey) # TL: Added rootkey to XML out
@@ -2943,11 +3137,15 @@ class CellObject(object):
                     tmpel.append(tmpcel)
                 if "string_list" in self.data_conversions:
                     tmpcel = ET.Element("string_list")
-                    for s in self.data_conversions["string"]:
+                    for s in self.data_conversions["string_list"]:
                         tmpccel = ET.Element("string")
                         tmpccel.text = s
                         tmpcel.append(tmpccel)
                     tmpel.append(tmpcel)
+                if "filetime" in self.data_conversions:
+                    tmpcel = ET.Element("filetime")
+                    tmpcel.text = self.data_conversions["filetime"].strftime("%Y-%m-%dT%H:%M:%SZ")
+                    tmpel.append(tmpcel)
 
             _anno_change(tmpel)
             outel.append(tmpel)
@@ -2962,7 +3160,67 @@ class CellObject(object):
         return outel
 
     def to_regxml(self):
-        return _ET_tostring(self.to_Element())
+        """Serializes this CellObject to a string, identical to _ET_tostring(self.to_Element()).  Common objects are written directly as text without building an Element; objects with diffs, byte runs or an original object fall back to to_Element()."""
+        if self.diffs or self.byte_runs or \
+          not self.original_cellobject is None or \
+          not self.annos <= CellObject._diff_attr_names.keys():
+            return _ET_tostring(self.to_Element())
+
+        self.sanity_check()
+
+        attribs = "".join(' %s="1"' % CellObject._diff_attr_names[annodiff] for annodiff in CellObject._diff_attr_names if annodiff in self.annos)
+        if self.root:
+            attribs += ' root="%s"' % _xml_escape_attrib(str(self.root))
+        parts = []
+
+        def _str(name, value, attrib=""):
+            if not value is None:
+                _xml_text_element(parts, name, str(value), attrib)
+
+        _str("cellpath", self.cellpath)
+        _str("cellpath_norm", self.cellpath_norm)
+        _str("basename", self.basename)
+        _str("basename_norm", self.basename_norm)
+        _str("error", self.error)
+        _str("name_type", self.name_type)
+        if not self.alloc is None:
+            parts.append("<alloc>%s</alloc>" % ("1" if self.alloc else "0"))
+        if not self.mtime is None:
+            _xml_time_element(parts, "mtime", self.mtime)
+        _str("data_type", self.data_type)
+        if not self.data_encoding is None:
+            _str("data", self.data, ' encoding="%s"' % _xml_escape_attrib(self.data_encoding))
+        else:
+            _str("data", self.data)
+        _str("data_raw", _hexstr(self.data_raw))
+        _str("app_name", self.app_name)
+        _str("app_state", self.app_state)
+        _str("rootkey", self.rootkey)
+
+        if not self.data_conversions is None:
+            conversions = []
+            if "int" in self.data_conversions:
+                _xml_text_element(conversions, "int", str(self.data_conversions["int"]))
+            if "string" in self.data_conversions:
+                _xml_text_element(conversions, "string", str(self.data_conversions["string"]))
+            if "string_list" in self.data_conversions:
+                strings = []
+                for string in self.data_conversions["string_list"]:
+                    _xml_text_element(strings, "string", string)
+                if strings:
+                    conversions.append("<string_list>%s</string_list>" % "".join(strings))
+                else:
+                    conversions.append("<string_list />")
+            if "filetime" in self.data_conversions:
+                _xml_text_element(conversions, "filetime", self.data_conversions["filetime"].strftime("%Y-%m-%dT%H:%M:%SZ"))
+            if conversions:
+                parts.append("<data_conversions>%s</data_conversions>" % "".join(conversions))
+            else:
+                parts.append("<data_conversions />")
+
+        if not parts:
+            return "<cellobject%s />" % attribs
+        return "<cellobject%s>%s</cellobject>" % (attribs, "".join(parts))
 
     @property
     def alloc(self):
@@ -3087,14 +3345,18 @@ class CellObject(object):
     # TL: Added data_raw getter
     @property
     def data_raw(self):
+        """Raw value data as bytes.  Hexadecimal text (e.g. "54 00 72 00") is decoded once when set; see data_raw_hex for the serialized form."""
         return self._data_raw
 
     # TL: Added data_raw setter
     @data_raw.setter
     def data_raw(self, val):
-        if not val is None:
-            _typecheck(val, str)
-        self._data_raw = val
+        self._data_raw = _hexcast(val)
+
+    @property
+    def data_raw_hex(self):
+        """Space-separated hexadecimal text of data_raw, as written to APXML.  Read-only."""
+        return _hexstr(self._data_raw)
 
     @property
     def data_type(self):
@@ -3506,6 +3768,20 @@ if __name__ == "__main__":
     assert _intcast("-1") == -1
     assert _qsplit("{http://www.w3.org/2001/XMLSchema}all") == ("http://www.w3.org/2001/XMLSchema","all")
     assert _qsplit("http://www.w3.org/2001/XMLSchema}all") == (None, "http://www.w3.org/2001/XMLSchema}all")
+    assert _hexcast("54 00 72 00") == b"T\x00r\x00"
+    assert _hexstr(b"T\x00r\x00") == "54 00 72 00"
+    assert _hexcast(None) is None
+    assert _filetimecast(130837046550000000) == datetime.datetime(2015, 8, 10, 18, 24, 15)
+    assert _filetimecast(0) is None
+
+    co = CellObject(data_type="REG_MULTI_SZ", data_raw="61 00 00 00 62 00 63 00 00 00 00 00")
+    assert co.decode_data_raw() == {"string_list": ["a", "bc"]}
+    co = CellObject(data_type="REG_DWORD", data_raw="05 00 00 00")
+    assert co.decode_data_raw() == {"int": 5}
+    co = CellObject()
+    co.populate_from_Element(ET.fromstring("<cellobject><cellpath>HKLM\\Foo</cellpath><data_raw>5G 00</data_raw></cellobject>"))
+    assert co.cellpath == "HKLM\\Foo"
+    assert co.data_raw is None
 
 
     fi = FileObject()
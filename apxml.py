@@ -36,7 +36,10 @@ __version__ = '0.1.0'
 
 import os
 import sys
+import json
+import struct
 import datetime
+import itertools
 import collections
 import xml.etree.ElementTree as ET
 
@@ -193,8 +196,9 @@ class APXMLObject(object):
         else:
             raise TypeError("Type Error: %r." % type(obj))                          
 
-    def to_Element(self):
-        """ Convert an APXMLObject to ElementTree Object. """
+    def to_partial_Element(self):
+        """ Convert the APXMLObject header (root, metadata and creator) to
+            an ElementTree Object. No files, cells or rusage. """
         outel = ET.Element("apxml")
 
         # Set APXML version
@@ -216,6 +220,12 @@ class APXMLObject(object):
         tmpel0 = self.creator.to_Element()
         outel.append(tmpel0)
 
+        return outel
+
+    def to_Element(self):
+        """ Convert an APXMLObject to ElementTree Object. """
+        outel = self.to_partial_Element()
+
         # Write FileObjects and CellObjects to APXML document
         for state in self._all_states:
             for fi in self._files:
@@ -235,6 +245,36 @@ class APXMLObject(object):
         """ Write an APXMLObject to XML. """
         return _ET_tostring(self.to_Element())
 
+    def print_apxml(self, output_fh=sys.stdout, objects=None):
+        """ Stream an APXML document to output_fh: the header of this
+            APXMLObject, each FileObject and CellObject from objects
+            (default: the objects of this APXMLObject) in order, then the
+            rusage. The first object is read before the header is written,
+            so objects can be iterparse_objects(filename, self). """
+        if objects is None:
+            objects = self
+        objects = iter(objects)
+        first = next(objects, None)
+
+        apxml_wrapper = _ET_tostring(self.to_partial_Element())
+        apxml_foot = "</apxml>"
+        apxml_head = apxml_wrapper.strip()[:-len(apxml_foot)]
+
+        output_fh.write("""<?xml version="1.0"?>\n""")
+        output_fh.write(apxml_head)
+        output_fh.write("\n")
+        if first is not None:
+            for obj in itertools.chain([first], objects):
+                if isinstance(obj, Objects.FileObject):
+                    output_fh.write(obj.to_dfxml())
+                else:
+                    output_fh.write(obj.to_regxml())
+                output_fh.write("\n")
+        output_fh.write(_ET_tostring(self.rusage.to_Element()))
+        output_fh.write("\n")
+        output_fh.write(apxml_foot)
+        output_fh.write("\n")
+
     # version setter and getter
     @property
     def version(self):
@@ -564,60 +604,312 @@ def generate_stats(apxml_obj):
 
 
 ################################################################################
-def iterparse(filename, events=("start", "end"), **kwargs):
-    """ Generator. Parses an APXML document to an APXMLObject. """
+_FILEOBJECT_TAG = "<fileobject".encode("utf-16-le")
+_CELLOBJECT_TAG = "<cellobject".encode("utf-16-le")
+
+def count_objects(filename, chunk_size=4194304):
+    """ Count the FileObjects and CellObjects in an APXML document by
+        scanning its bytes for their start tags, without parsing it.
+        Returns a (files, cells) tuple. """
+    files = 0
+    cells = 0
+    # Keep one byte less than a tag, so a tag split between two chunks is
+    # counted once, in the second chunk
+    overlap = len(_FILEOBJECT_TAG) - 1
+    tail = b""
+    with open(filename, "rb") as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            data = tail + chunk
+            files += data.count(_FILEOBJECT_TAG)
+            cells += data.count(_CELLOBJECT_TAG)
+            tail = data[-overlap:]
+    return (files, cells)
 
-    # Open file handle to APXML doucment
-    fh = open(filename, encoding='utf-16-le', errors='replace')
+################################################################################
+def decode_cells(apxml_obj):
+    """ Decode the data_raw of every CellObject into data_conversions.
+        Fixed-width values (REG_DWORD, REG_QWORD, 8-byte REG_BINARY) are
+        grouped by struct format and unpacked with one struct.iter_unpack
+        call per group. Other values are decoded one at a time. """
 
-    # Create APXMLObject to store all profile information
-    apxml = APXMLObject()
+    # Check if we have an APXMLObject
+    if not isinstance(apxml_obj, APXMLObject):
+        return
 
-    # Call ElementTree iterparse on APXML document
-    for (ETevent, elem) in ET.iterparse(fh, events=("start-ns", "start", "end")):
+    formats = Objects.CellObject._data_raw_formats
+    groups = collections.OrderedDict()
 
-        #Track namespaces
-        if ETevent == "start-ns":
-            apxml.add_namespace(*elem)
-            ET.register_namespace(*elem)
+    for cell in apxml_obj._cells:
+        if cell.data_raw is None:
             continue
+        if cell.data_type in formats:
+            (fmt, key) = formats[cell.data_type]
+            # Values of the wrong width cannot be decoded
+            if len(cell.data_raw) == struct.calcsize(fmt):
+                groups.setdefault((fmt, key), []).append(cell)
+        else:
+            cell.decode_data_raw()
+
+    for (fmt, key), cells in groups.items():
+        blob = b"".join(cell.data_raw for cell in cells)
+        for cell, value in zip(cells, struct.iter_unpack(fmt, blob)):
+            cell.set_data_conversion(key, value[0])
+
+################################################################################
+def iterparse_objects(filename, apxml_obj=None):
+    """ Generator. Parses an APXML document and yields each FileObject and
+        CellObject as soon as it has been read, without keeping the XML
+        tree. The metadata, creator and rusage elements and namespaces are
+        populated on apxml_obj, if given. Objects are not appended to it. """
+
+    if apxml_obj is None:
+        apxml_obj = APXMLObject()
+
+    # Open file handle to APXML doucment. The with statement also closes
+    # it if parsing fails, or the consumer stops before the end
+    with open(filename, encoding='utf-16-le', errors='replace') as fh:
+        root = None
+
+        # Call ElementTree iterparse on APXML document
+        for (ETevent, elem) in ET.iterparse(fh, events=("start-ns", "start", "end")):
+
+            #Track namespaces
+            if ETevent == "start-ns":
+                apxml_obj.add_namespace(*elem)
+                ET.register_namespace(*elem)
+                continue
+
+            # Keep the root element, so processed children can be released
+            if ETevent == "start":
+                if root is None:
+                    root = elem
+                continue
 
-        # Split element to namespace and tag name
-        (ns, ln) = _qsplit(elem.tag)
+            # Split element to namespace and tag name
+            (ns, ln) = _qsplit(elem.tag)
 
-        # Process each XML tag
-        if ETevent == "start":
+            # Process each XML tag once it is complete
             if ln == "metadata":
                 metadata = MetadataObject()
                 metadata.populate_from_Element(elem)
-                apxml.metadata = metadata
+                apxml_obj.metadata = metadata
 
             elif ln == "creator":
                 creator = CreatorObject()
                 creator.populate_from_Element(elem)
-                apxml.creator = creator
+                apxml_obj.creator = creator
 
             elif ln == "rusage":
                 rusage = RusageObject()
                 rusage.populate_from_Element(elem)
-                apxml.rusage = rusage
+                apxml_obj.rusage = rusage
 
-        elif ETevent == "end":
-            if ln == "fileobject":
+            elif ln == "fileobject":
                 fo = Objects.FileObject()
                 fo.populate_from_Element(elem)
-                apxml.append(fo)
-                apxml._all_states[fo.app_state] = None
+                apxml_obj._all_states[fo.app_state] = None
+                root.clear()
+                yield fo
 
             elif ln == "cellobject":
                 co = Objects.CellObject()
                 co.populate_from_Element(elem)
-                apxml.append(co)
-                apxml._all_states[co.app_state] = None
+                apxml_obj._all_states[co.app_state] = None
+                root.clear()
+                yield co
+
+def iterparse(filename, events=("start", "end"), **kwargs):
+    """ Parses an APXML document to an APXMLObject. """
+
+    # Create APXMLObject to store all profile information
+    apxml = APXMLObject()
+
+    for obj in iterparse_objects(filename, apxml):
+        apxml.append(obj)
 
     # All done, return the APXMLObject
     return apxml
 
+################################################################################
+# JSON Lines interchange format: one header line, one line per FileObject
+# or CellObject, then one rusage line. Each line is a JSON object with a
+# "type" member. None values are omitted.
+_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+_JSONL_FILE_PROPERTIES = ["filename",
+                          "filename_norm",
+                          "basename",
+                          "basename_norm",
+                          "orphan_name",
+                          "filesize",
+                          "alloc",
+                          "alloc_inode",
+                          "alloc_name",
+                          "meta_type",
+                          "name_type",
+                          "inode",
+                          "mtime",
+                          "ctime",
+                          "atime",
+                          "crtime",
+                          "md5",
+                          "sha1",
+                          "app_name",
+                          "app_state"]
+
+_JSONL_CELL_PROPERTIES = ["cellpath",
+                          "cellpath_norm",
+                          "basename",
+                          "basename_norm",
+                          "name_type",
+                          "alloc",
+                          "root",
+                          "mtime",
+                          "data_type",
+                          "data",
+                          "data_encoding",
+                          "rootkey",
+                          "app_name",
+                          "app_state"]
+
+def _header_to_dict(obj):
+    """ Convert a Metadata, Creator, ExecutionEnvironment or Rusage
+        object to a dictionary. """
+    d = dict()
+    for prop in sorted(obj._all_properties):
+        val = getattr(obj, prop)
+        if val is None:
+            continue
+        if isinstance(val, ExecutionEnvironmentObject):
+            val = _header_to_dict(val)
+        elif isinstance(val, datetime.datetime):
+            val = val.strftime(_DATE_FORMAT)
+        d[prop] = val
+    return d
+
+def header_to_dict(apxml_obj):
+    """ Convert the APXMLObject header (version, namespaces, metadata and
+        creator) to the JSON Lines header dictionary. """
+    return {"type": "apxml",
+            "version": apxml_obj.version,
+            "namespaces": dict(apxml_obj.iter_namespaces()),
+            "metadata": _header_to_dict(apxml_obj.metadata),
+            "creator": _header_to_dict(apxml_obj.creator)}
+
+def rusage_to_dict(apxml_obj):
+    """ Convert the APXMLObject rusage to the JSON Lines footer dictionary. """
+    d = _header_to_dict(apxml_obj.rusage)
+    d["type"] = "rusage"
+    return d
+
+def _timestamp_to_dict(ts):
+    """ Convert a TimestampObject to a dictionary of its time and, if set,
+        its precision (e.g., "100ns"). """
+    d = dict()
+    if ts.time:
+        d["time"] = str(ts.time)
+    if ts.prec:
+        d["prec"] = "%d%s" % ts.prec
+    return d
+
+def object_to_dict(obj):
+    """ Convert a FileObject or CellObject to a JSON-serializable
+        dictionary. """
+    if isinstance(obj, Objects.FileObject):
+        d = {"type": "fileobject"}
+        properties = _JSONL_FILE_PROPERTIES
+    elif isinstance(obj, Objects.CellObject):
+        d = {"type": "cellobject"}
+        properties = _JSONL_CELL_PROPERTIES
+    else:
+        raise TypeError("Type Error: %r." % type(obj))
+
+    for prop in properties:
+        val = getattr(obj, prop)
+        if val is None:
+            continue
+        # FileObject.alloc is derived when alloc_inode/alloc_name are set
+        if prop == "alloc" and d["type"] == "fileobject" and \
+           not (obj.alloc_inode is None and obj.alloc_name is None):
+            continue
+        if isinstance(val, Objects.TimestampObject):
+            val = _timestamp_to_dict(val)
+        d[prop] = val
+
+    if obj.annos:
+        d["annos"] = sorted(obj.annos)
+
+    if isinstance(obj, Objects.CellObject):
+        if obj.data_raw is not None:
+            d["data_raw"] = obj.data_raw_hex
+        if obj.data_conversions:
+            conversions = dict(obj.data_conversions)
+            if "filetime" in conversions:
+                conversions["filetime"] = conversions["filetime"].strftime(_DATE_FORMAT)
+            d["data_conversions"] = conversions
+    return d
+
+def object_from_dict(d):
+    """ Rebuild a FileObject or CellObject from a dictionary created by
+        object_to_dict. """
+    d = dict(d)
+    obj_type = d.pop("type")
+    annos = set(d.pop("annos", []))
+    for prop in Objects.TimestampObject.timestamp_name_list:
+        if isinstance(d.get(prop), dict):
+            d[prop] = Objects.TimestampObject(d[prop].get("time"),
+                                              prec=d[prop].get("prec"),
+                                              name=prop)
+    if obj_type == "fileobject":
+        obj = Objects.FileObject(**d)
+    elif obj_type == "cellobject":
+        conversions = d.pop("data_conversions", None)
+        obj = Objects.CellObject(**d)
+        if conversions is not None:
+            if "filetime" in conversions:
+                conversions["filetime"] = _datecast(conversions["filetime"])
+            obj.data_conversions = conversions
+    else:
+        raise ValueError("Unexpected JSON Lines object type: %r." % obj_type)
+    obj.annos = annos
+    return obj
+
+def parse_jsonl(filename):
+    """ Parses an APXML JSON Lines document (see APXML2JSONL.py) to an
+        APXMLObject. """
+
+    apxml = APXMLObject()
+
+    with open(filename, encoding='utf-8') as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            d = json.loads(line)
+            obj_type = d.get("type")
+
+            if obj_type in ["fileobject", "cellobject"]:
+                obj = object_from_dict(d)
+                apxml.append(obj)
+                apxml._all_states[obj.app_state] = None
+
+            elif obj_type == "apxml":
+                apxml.version = d.get("version")
+                for prefix, url in d.get("namespaces", {}).items():
+                    apxml.add_namespace(prefix, url)
+                apxml.metadata = MetadataObject(**d.get("metadata", {}))
+                creator = dict(d.get("creator", {}))
+                execution = creator.pop("execution_environment", {})
+                apxml.creator = CreatorObject(**creator)
+                apxml.creator.execution_environment = ExecutionEnvironmentObject(**execution)
+
+            elif obj_type == "rusage":
+                apxml.rusage = RusageObject(end_date=d.get("end_date"))
+
+    return apxml
+
 ################################################################################
 ################################################################################
 if __name__=='__main__':
@@ -636,4 +928,13 @@ if __name__=='__main__':
     # Test datecast method
     assert _datecast("2015-08-10T18:24:15Z") == datetime.datetime(2015, 8, 10, 18, 24, 15)
 
+    # Test object_to_dict and object_from_dict keep timestamp precision
+    fi = Objects.FileObject(filename="C:\\file.txt", app_state="install")
+    fi.mtime = Objects.TimestampObject("2015-08-10T18:24:15Z", prec="100ns", name="mtime")
+    d = json.loads(json.dumps(object_to_dict(fi)))
+    assert d["mtime"] == {"time": "2015-08-10T18:24:15Z", "prec": "100ns"}
+    fi2 = object_from_dict(d)
+    assert fi2.mtime == fi.mtime
+    assert fi2.mtime.prec == (100, "ns")
+
     print("\nModule tests passed.\n")